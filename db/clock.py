@@ -0,0 +1,38 @@
+import asyncio
+from datetime import datetime, timedelta, timezone, date
+
+from db.db_main import get_pool
+from init import logging
+
+CLOCK_SYNC_INTERVAL = 3600  # секунд между сверками часов с БД
+
+# Разница между часами БД и локальными часами; обработчики узнают текущую дату
+# без запроса SELECT NOW()
+_db_offset = timedelta(0)
+
+async def sync_db_clock():
+    """Сверяет локальные часы с часами БД"""
+    global _db_offset
+    db_pool = get_pool()
+    before = datetime.now(timezone.utc)
+    db_now = await db_pool.fetchval_named("db_now")
+    after = datetime.now(timezone.utc)
+    # Время БД соответствует середине запроса
+    _db_offset = db_now - (before + (after - before) / 2)
+    logging.info(f"🕒 Часы синхронизированы с БД, расхождение: {_db_offset.total_seconds():.3f} с")
+
+async def start_db_clock_sync_cycle():
+    while True:
+        await asyncio.sleep(CLOCK_SYNC_INTERVAL)
+        try:
+            await sync_db_clock()
+        except Exception as e:
+            logging.error(f"⚠️ Ошибка синхронизации часов с БД: {e}")
+
+def db_now() -> datetime:
+    """Текущее время по часам БД (UTC)"""
+    return datetime.now(timezone.utc) + _db_offset
+
+def db_today() -> date:
+    """Текущая дата по часам БД, как NOW()::date из asyncpg (UTC)"""
+    return db_now().date()
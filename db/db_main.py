@@ -1,18 +1,200 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
 import asyncpg
-from init import DB_URL, logging
+from init import (
+    DB_URL, logging,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_STATEMENT_CACHE_SIZE,
+    DB_MAX_INACTIVE_LIFETIME, DB_COMMAND_TIMEOUT, DB_ACQUIRE_TIMEOUT,
+    DB_STATEMENT_TIMEOUT_MS, DB_APPLICATION_NAME
+)
+from db.queries import QUERIES
 
 pool = None
 
+class CatalogConnection(asyncpg.Connection):
+    """Соединение с подготовленными запросами из каталога db/queries.py"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._catalog = {}
+
+    async def _catalog_statement(self, name: str):
+        statement = self._catalog.get(name)
+        if statement is None:
+            statement = await self.prepare(QUERIES[name])
+            self._catalog[name] = statement
+        return statement
+
+    async def prepare_catalog(self):
+        """Подготавливает все запросы каталога на этом соединении"""
+        for name in QUERIES:
+            try:
+                await self._catalog_statement(name)
+            except (asyncpg.UndefinedTableError, asyncpg.UndefinedFunctionError):
+                # Схема или расширения (pg_trgm) ещё не созданы миграциями —
+                # подготовим при первом вызове
+                pass
+
+    async def fetch_named(self, name: str, *args, timeout: float | None = None):
+        statement = await self._catalog_statement(name)
+        return await statement.fetch(*args, timeout=timeout)
+
+    async def fetchrow_named(self, name: str, *args, timeout: float | None = None):
+        statement = await self._catalog_statement(name)
+        return await statement.fetchrow(*args, timeout=timeout)
+
+    async def fetchval_named(self, name: str, *args, column: int = 0, timeout: float | None = None):
+        statement = await self._catalog_statement(name)
+        return await statement.fetchval(*args, column=column, timeout=timeout)
+
+    async def execute_named(self, name: str, *args, timeout: float | None = None) -> str:
+        """Выполняет запрос и возвращает статус, как conn.execute (например, 'DELETE 3')"""
+        statement = await self._catalog_statement(name)
+        await statement.fetch(*args, timeout=timeout)
+        return statement.get_statusmsg()
+
+    async def executemany_named(self, name: str, args, *, timeout: float | None = None):
+        statement = await self._catalog_statement(name)
+        await statement.executemany(args, timeout=timeout)
+
+async def _init_connection(conn: CatalogConnection):
+    await conn.prepare_catalog()
+
+class InstrumentedPool:
+    """Обёртка над asyncpg.Pool, считающая время ожидания соединений.
+
+    Повторяет используемую в боте часть API пула (acquire/fetch/execute/...),
+    поэтому вызывающий код не меняется.
+    """
+
+    def __init__(self, raw_pool: asyncpg.Pool, acquire_timeout: float):
+        self._pool = raw_pool
+        self._acquire_timeout = acquire_timeout
+        self.acquire_count = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
+        self.acquire_timeouts = 0
+        self.in_use = 0
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout: float | None = None):
+        started = time.perf_counter()
+        try:
+            conn = await self._pool.acquire(timeout=timeout or self._acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            logging.warning("⚠️ Таймаут ожидания свободного соединения с БД")
+            raise
+
+        waited = time.perf_counter() - started
+        self.acquire_count += 1
+        self.acquire_wait_total += waited
+        self.acquire_wait_max = max(self.acquire_wait_max, waited)
+        self.in_use += 1
+        try:
+            yield conn
+        finally:
+            self.in_use -= 1
+            await self._pool.release(conn)
+
+    async def execute(self, query: str, *args, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, timeout=timeout)
+
+    async def executemany(self, command: str, args, *, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.executemany(command, args, timeout=timeout)
+
+    async def fetch(self, query: str, *args, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, timeout=timeout)
+
+    async def fetchval(self, query: str, *args, column: int = 0, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, column=column, timeout=timeout)
+
+    async def fetchrow(self, query: str, *args, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, timeout=timeout)
+
+    async def fetch_named(self, name: str, *args, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetch_named(name, *args, timeout=timeout)
+
+    async def fetchrow_named(self, name: str, *args, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetchrow_named(name, *args, timeout=timeout)
+
+    async def fetchval_named(self, name: str, *args, column: int = 0, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetchval_named(name, *args, column=column, timeout=timeout)
+
+    async def execute_named(self, name: str, *args, timeout: float | None = None) -> str:
+        async with self.acquire() as conn:
+            return await conn.execute_named(name, *args, timeout=timeout)
+
+    async def executemany_named(self, name: str, args, *, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.executemany_named(name, args, timeout=timeout)
+
+    async def expire_connections(self):
+        """Пересоздаёт соединения (например, после миграций схемы)"""
+        await self._pool.expire_connections()
+
+    async def close(self):
+        await self._pool.close()
+
+    def get_stats(self) -> dict:
+        """Снимок состояния пула для мониторинга"""
+        size = self._pool.get_size()
+        return {
+            "size": size,
+            "min_size": self._pool.get_min_size(),
+            "max_size": self._pool.get_max_size(),
+            "in_use": self.in_use,
+            "idle": self._pool.get_idle_size(),
+            "acquire_count": self.acquire_count,
+            "acquire_wait_avg_ms": (
+                self.acquire_wait_total / self.acquire_count * 1000 if self.acquire_count else 0.0
+            ),
+            "acquire_wait_max_ms": self.acquire_wait_max * 1000,
+            "acquire_timeouts": self.acquire_timeouts,
+        }
+
 def get_pool():
     """Возвращает текущий пул соединений"""
     global pool
     return pool
 
+def get_pool_stats() -> dict | None:
+    """Возвращает статистику пула или None, если пул не создан"""
+    return pool.get_stats() if pool else None
+
 async def init_db_pool():
-    """Создает пул соединений"""
+    """Создает пул соединений с настройками из окружения"""
     global pool
     if not pool:
-        pool = await asyncpg.create_pool(dsn=DB_URL)
+        raw_pool = await asyncpg.create_pool(
+            dsn=DB_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            connection_class=CatalogConnection,
+            init=_init_connection,
+            server_settings={
+                "application_name": DB_APPLICATION_NAME,
+                "statement_timeout": str(DB_STATEMENT_TIMEOUT_MS),
+            }
+        )
+        pool = InstrumentedPool(raw_pool, DB_ACQUIRE_TIMEOUT)
+        logging.info(
+            f"🔌 Пул БД создан: min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}, "
+            f"statement_cache={DB_STATEMENT_CACHE_SIZE}"
+        )
 
 async def close_db():
     """Закрывает пул соединений с базой данных"""
@@ -20,32 +202,3 @@ async def close_db():
     if pool:
         await pool.close()
         pool = None
-
-async def create_table():
-    """Создает таблицы, если их нет"""
-    db_pool = get_pool()
-    async with db_pool.acquire() as conn:
-        # Таблица пользователей должна создаваться первой (на неё ссылается другая таблица)
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(100),
-                first_name VARCHAR(100),
-                last_name VARCHAR(100),
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS expenses (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                category VARCHAR(50) NOT NULL,
-                amount DECIMAL(10, 2) NOT NULL,
-                currency VARCHAR(3) DEFAULT 'RUB',
-                date DATE NOT NULL DEFAULT CURRENT_DATE,
-                time TIME,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
\ No newline at end of file
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import time
+from datetime import date, datetime
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+from db.db_main import get_pool
+from init import logging
+
+FSM_FLUSH_INTERVAL = 0.5  # секунд между пакетными записями в БД
+# Через сколько секунд состояние перечитывается из БД. При нескольких процессах
+# пользователь закреплён за одним из них, так что чужих изменений в кэше не бывает
+FSM_CACHE_TTL = 300
+FSM_STATE_TTL_DAYS = 2  # состояния старше этого срока считаются истёкшими
+
+#region Сериализация данных FSM
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    if isinstance(value, tuple):
+        return [_encode_value(v) for v in value]
+    if isinstance(value, list):
+        return [_encode_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _encode_value(v) for k, v in value.items()}
+    return value
+
+def _decode_hook(obj: dict):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    return obj
+
+def dump_fsm_data(data: Dict[str, Any]) -> str:
+    return json.dumps(_encode_value(data), ensure_ascii=False)
+
+def load_fsm_data(raw: str | None) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_decode_hook) if raw else {}
+#endregion
+
+class PostgresStorage(BaseStorage):
+    """Хранилище FSM в PostgreSQL с кэшем в памяти.
+
+    Чтение идёт из памяти (как у MemoryStorage), запись — сразу в кэш и пачкой
+    в БД раз в FSM_FLUSH_INTERVAL. Так состояние переживает перезапуск
+    и доступно другим процессам бота.
+    """
+
+    def __init__(self):
+        # ключ -> {"state", "data", "loaded_at"}
+        self._cache: Dict[str, dict] = {}
+        self._dirty: set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny
+        ))
+
+    async def _get_record(self, key: StorageKey) -> dict:
+        db_key = self._key(key)
+        record = self._cache.get(db_key)
+        if record is not None and (
+            db_key in self._dirty or record["loaded_at"] + FSM_CACHE_TTL > time.monotonic()
+        ):
+            return record
+
+        started = time.monotonic()
+        row = await get_pool().fetchrow_named("fsm_get", db_key, FSM_STATE_TTL_DAYS)
+        # Пока шёл запрос, параллельный апдейт того же пользователя мог загрузить
+        # или уже изменить запись — её и возвращаем, иначе перезапишем свежее устаревшим
+        current = self._cache.get(db_key)
+        if current is not None and (db_key in self._dirty or current["loaded_at"] >= started):
+            return current
+        record = {
+            "state": row["state"] if row else None,
+            "data": load_fsm_data(row["data"]) if row else {},
+            "loaded_at": time.monotonic(),
+        }
+        self._cache[db_key] = record
+        return record
+
+    def _mark_dirty(self, key: StorageKey, record: dict):
+        db_key = self._key(key)
+        record["loaded_at"] = time.monotonic()
+        self._cache[db_key] = record
+        self._dirty.add(db_key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record["state"] = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get_record(key)
+        return record["state"]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record["data"] = data.copy()
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        return record["data"].copy()
+
+    async def flush(self):
+        """Записывает изменённые состояния в БД одним запросом"""
+        if not self._dirty:
+            return
+        db_pool = get_pool()
+        if not db_pool:
+            return
+
+        keys, states, datas = [], [], []
+        for db_key in self._dirty:
+            record = self._cache[db_key]
+            try:
+                data = dump_fsm_data(record["data"])
+            except (TypeError, ValueError) as e:
+                # Одно несериализуемое значение не должно останавливать запись остальных
+                logging.error("❌ Данные FSM %s не сериализуются в JSON, не сохраняю: %s", db_key, e)
+                continue
+            keys.append(db_key)
+            states.append(record["state"])
+            datas.append(data)
+        self._dirty = set()
+        if not keys:
+            return
+
+        try:
+            await db_pool.execute_named("fsm_upsert_many", keys, states, datas)
+        except Exception as e:
+            logging.error("❌ Ошибка при сохранении состояний FSM: %s", e)
+            self._dirty.update(keys)
+
+    def _evict_stale(self):
+        now = time.monotonic()
+        for db_key in [
+            k for k, r in self._cache.items()
+            if k not in self._dirty and r["loaded_at"] + FSM_CACHE_TTL <= now
+        ]:
+            del self._cache[db_key]
+
+    async def _flush_cycle(self):
+        last_cleanup = time.monotonic()
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                self._evict_stale()
+            except Exception:
+                logging.exception("❌ Ошибка в цикле записи состояний FSM")
+            if time.monotonic() - last_cleanup > 3600:
+                last_cleanup = time.monotonic()
+                try:
+                    await get_pool().execute_named("fsm_delete_expired", FSM_STATE_TTL_DAYS)
+                except Exception as e:
+                    logging.error("❌ Ошибка при удалении устаревших состояний FSM: %s", e)
+
+    def start(self):
+        """Запускает фоновую запись в БД (после инициализации пула)"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_cycle())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
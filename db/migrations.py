@@ -0,0 +1,270 @@
+import re
+
+import asyncpg
+from db.db_main import get_pool
+from init import logging, DB_MIGRATIONS_CONCURRENTLY
+
+MIGRATIONS_LOCK_ID = 7_301_001  # ключ advisory-блокировки, чтобы миграции не шли параллельно
+MIGRATION_TIMEOUT = 3600  # секунд: построение индекса на большой таблице может идти долго
+
+_CREATE_INDEX_NAME = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+# Каждая миграция применяется один раз, номер версии записывается в schema_migrations.
+# В миграциях с "indexes": True выражение {concurrently} заменяется на CONCURRENTLY,
+# если включён DB_MIGRATIONS_CONCURRENTLY; такие миграции выполняются вне транзакции.
+MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "base_tables",
+        "statements": [
+            # Таблица пользователей должна создаваться первой (на неё ссылаются другие таблицы)
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username VARCHAR(100),
+                first_name VARCHAR(100),
+                last_name VARCHAR(100),
+                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS expenses (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                category VARCHAR(50) NOT NULL,
+                amount DECIMAL(10, 2) NOT NULL,
+                currency VARCHAR(3) DEFAULT 'RUB',
+                date DATE NOT NULL DEFAULT CURRENT_DATE,
+                time TIME,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS user_categories (
+                user_id BIGINT NOT NULL,
+                category TEXT NOT NULL,
+                PRIMARY KEY (user_id, category)
+            )
+            ''',
+        ],
+    },
+    {
+        "version": 2,
+        "name": "hot_path_indexes",
+        "indexes": True,
+        "statements": [
+            # История расходов: ORDER BY date DESC, (time IS NULL), time DESC, created_at DESC
+            '''
+            CREATE INDEX {concurrently} IF NOT EXISTS idx_expenses_user_date
+            ON expenses (user_id, date DESC, time DESC NULLS LAST, created_at DESC)
+            ''',
+            # Статистика и история по категориям
+            '''
+            CREATE INDEX {concurrently} IF NOT EXISTS idx_expenses_user_category_date
+            ON expenses (user_id, category, date)
+            ''',
+            # Поиск категории без учёта регистра
+            '''
+            CREATE INDEX {concurrently} IF NOT EXISTS idx_user_categories_user_lower
+            ON user_categories (user_id, LOWER(category))
+            ''',
+        ],
+    },
+    {
+        "version": 3,
+        "name": "expenses_created_at_not_null",
+        "statements": [
+            # created_at входит в ключ постраничного вывода и не должен быть NULL
+            "UPDATE expenses SET created_at = date::timestamp WHERE created_at IS NULL",
+            "ALTER TABLE expenses ALTER COLUMN created_at SET NOT NULL",
+        ],
+    },
+    {
+        "version": 4,
+        "name": "history_keyset_indexes",
+        "indexes": True,
+        "statements": [
+            # Ключ совпадает с _HISTORY_KEY из db/queries.py
+            '''
+            CREATE INDEX {concurrently} IF NOT EXISTS idx_expenses_user_keyset
+            ON expenses (
+                user_id, date DESC, (time IS NOT NULL) DESC,
+                COALESCE(time, TIME '00:00') DESC, created_at DESC, id DESC
+            )
+            ''',
+            '''
+            CREATE INDEX {concurrently} IF NOT EXISTS idx_expenses_user_category_keyset
+            ON expenses (
+                user_id, category, date DESC, (time IS NOT NULL) DESC,
+                COALESCE(time, TIME '00:00') DESC, created_at DESC, id DESC
+            )
+            ''',
+            # Прежние индексы полностью покрываются новыми
+            "DROP INDEX {concurrently} IF EXISTS idx_expenses_user_date",
+            "DROP INDEX {concurrently} IF EXISTS idx_expenses_user_category_date",
+        ],
+    },
+    {
+        "version": 5,
+        "name": "user_totals",
+        "statements": [
+            # Итоги по пользователю, обновляются в тех же транзакциях, что и expenses
+            '''
+            CREATE TABLE IF NOT EXISTS user_totals (
+                user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+                expenses_count BIGINT NOT NULL DEFAULT 0,
+                total_amount NUMERIC(14, 2) NOT NULL DEFAULT 0,
+                first_date DATE,
+                last_date DATE
+            )
+            ''',
+            '''
+            INSERT INTO user_totals (user_id, expenses_count, total_amount, first_date, last_date)
+            SELECT user_id, COUNT(*), SUM(amount), MIN(date), MAX(date)
+            FROM expenses
+            GROUP BY user_id
+            ON CONFLICT (user_id) DO NOTHING
+            ''',
+        ],
+    },
+    {
+        "version": 6,
+        "name": "expense_daily_rollup",
+        "statements": [
+            # Суммы по дням и категориям: статистика читает их вместо строк expenses
+            '''
+            CREATE TABLE IF NOT EXISTS expense_daily (
+                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                date DATE NOT NULL,
+                category VARCHAR(50) NOT NULL,
+                total NUMERIC(14, 2) NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, date, category)
+            )
+            ''',
+            '''
+            INSERT INTO expense_daily (user_id, date, category, total, count)
+            SELECT user_id, date, category, SUM(amount), COUNT(*)
+            FROM expenses
+            GROUP BY user_id, date, category
+            ON CONFLICT (user_id, date, category) DO NOTHING
+            ''',
+        ],
+    },
+    {
+        "version": 7,
+        "name": "fsm_storage",
+        "statements": [
+            '''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            "CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage (updated_at)",
+        ],
+    },
+    {
+        # Поиск расходов: точная дата идёт по idx_expenses_user_keyset (user_id, date, ...),
+        # сумма — по btree (user_id, amount), подстрока и похожие слова в категории —
+        # по триграммному GIN вместе с user_id (btree_gin), чтобы не смотреть чужие записи
+        "version": 8,
+        "name": "search_indexes",
+        "indexes": True,
+        "statements": [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE EXTENSION IF NOT EXISTS btree_gin",
+            '''
+            CREATE INDEX {concurrently} IF NOT EXISTS idx_expenses_user_amount
+            ON expenses (user_id, amount)
+            ''',
+            '''
+            CREATE INDEX {concurrently} IF NOT EXISTS idx_expenses_user_category_trgm
+            ON expenses USING gin (user_id, category gin_trgm_ops)
+            ''',
+        ],
+    },
+]
+
+async def _drop_invalid_index(conn: asyncpg.Connection, sql: str):
+    """Удаляет индекс, оставшийся INVALID после прерванного CREATE INDEX CONCURRENTLY.
+
+    Иначе IF NOT EXISTS при повторе пропустит построение, а миграция будет записана
+    как применённая, хотя индекс не используется планировщиком.
+    """
+    match = _CREATE_INDEX_NAME.search(sql)
+    if not match:
+        return
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)",
+        match.group(1)
+    )
+    if invalid:
+        logging.warning(f"⚠️ Индекс {match.group(1)} недостроен (INVALID), удаляю и строю заново")
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}", timeout=MIGRATION_TIMEOUT)
+
+async def _apply_migration(conn: asyncpg.Connection, migration: dict):
+    concurrently = "CONCURRENTLY" if DB_MIGRATIONS_CONCURRENTLY else ""
+    statements = [
+        sql.format(concurrently=concurrently) if migration.get("indexes") else sql
+        for sql in migration["statements"]
+    ]
+
+    if migration.get("indexes") and DB_MIGRATIONS_CONCURRENTLY:
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        for sql in statements:
+            await _drop_invalid_index(conn, sql)
+            try:
+                await conn.execute(sql, timeout=MIGRATION_TIMEOUT)
+            except Exception:
+                # Не оставляем INVALID-индекс до следующего запуска
+                try:
+                    await _drop_invalid_index(conn, sql)
+                except Exception as e:
+                    logging.error(f"❌ Не удалось удалить недостроенный индекс: {e}")
+                raise
+        await conn.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+            migration["version"], migration["name"]
+        )
+        return
+
+    async with conn.transaction():
+        for sql in statements:
+            await conn.execute(sql, timeout=MIGRATION_TIMEOUT)
+        await conn.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+            migration["version"], migration["name"]
+        )
+
+async def run_migrations():
+    """Применяет все ещё не применённые миграции по порядку версий"""
+    db_pool = get_pool()
+    async with db_pool.acquire() as conn:
+        # statement_timeout пула не должен обрывать ни построение индексов,
+        # ни ожидание блокировки, пока миграции применяет другой процесс
+        await conn.execute("SET statement_timeout = 0")
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID, timeout=MIGRATION_TIMEOUT)
+        try:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            applied = {
+                row['version']
+                for row in await conn.fetch("SELECT version FROM schema_migrations")
+            }
+
+            for migration in sorted(MIGRATIONS, key=lambda m: m["version"]):
+                if migration["version"] in applied:
+                    continue
+                logging.info(f"🧱 Применяю миграцию {migration['version']}: {migration['name']}")
+                await _apply_migration(conn, migration)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
@@ -0,0 +1,348 @@
+# Каталог всех SQL-запросов бота.
+# Каждый запрос полностью параметризован и подготавливается (PREPARE) на каждом
+# соединении пула, поэтому разбор и планирование выполняются один раз на соединение.
+# Вызов: await pool.fetch_named("имя", *параметры) или conn.fetch_named(...) в транзакции.
+
+# Порядок истории: новые даты выше, записи со временем выше записей без времени.
+# Совпадает с индексом idx_expenses_user_keyset, поэтому сравнение кортежей
+# ограничивает диапазон индекса и страница не зависит от глубины.
+_HISTORY_KEY = "date, (time IS NOT NULL), COALESCE(time, TIME '00:00'), created_at, id"
+_HISTORY_ORDER_DESC = (
+    "date DESC, (time IS NOT NULL) DESC, COALESCE(time, TIME '00:00') DESC, "
+    "created_at DESC, id DESC"
+)
+_HISTORY_ORDER_ASC = (
+    "date, (time IS NOT NULL), COALESCE(time, TIME '00:00'), created_at, id"
+)
+
+def _cursor_key(param: str) -> str:
+    """Ключ сортировки граничной записи по её id"""
+    return f"SELECT {_HISTORY_KEY} FROM expenses WHERE id = {param} AND user_id = $1"
+
+# Поиск: $2 — дата, $3/$4 — диапазон суммы, $5 — текст запроса; NULL отключает условие.
+# Каждая ветка OR идёт по своему индексу: дата — idx_expenses_user_keyset,
+# сумма — idx_expenses_user_amount, категория (подстрока или похожее слово
+# с опечаткой) — триграммный GIN idx_expenses_user_category_trgm.
+_SEARCH_FILTER = """(
+    date = $2::date
+    OR (amount >= $3::numeric AND amount < $4::numeric)
+    OR category ILIKE '%' || $5 || '%'
+    OR category % $5
+)"""
+# Точные совпадения по дате и сумме выше всего, затем по похожести категории
+_SEARCH_RANK = """GREATEST(
+    (date = $2::date)::int,
+    (amount >= $3::numeric AND amount < $4::numeric)::int,
+    similarity(category, $5)
+)"""
+# Выдача поиска: по релевантности, при равной — как история (свежие выше)
+_SEARCH_ORDER_DESC = f"{_SEARCH_RANK} DESC, {_HISTORY_ORDER_DESC}"
+
+QUERIES = {
+    #region Служебные
+    "db_now": "SELECT NOW()",
+    "db_current_date": "SELECT CURRENT_DATE",
+    #endregion
+
+    #region Пользователи
+    "user_upsert": """
+        INSERT INTO users (user_id, username, first_name, last_name)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = EXCLUDED.username,
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            last_active = CURRENT_TIMESTAMP
+        RETURNING (xmax = 0)
+    """,
+    "users_touch_activity": """
+        UPDATE users AS u
+        SET last_active = CURRENT_TIMESTAMP - v.age * INTERVAL '1 second'
+        FROM unnest($1::bigint[], $2::float8[]) AS v(user_id, age)
+        WHERE u.user_id = v.user_id
+    """,
+    "user_profile": """
+        SELECT username, first_name, last_name, join_date, last_active
+        FROM users WHERE user_id = $1
+    """,
+    "admin_user_stats": """
+        SELECT u.user_id, u.username,
+               COALESCE(t.expenses_count, 0) AS expenses_count,
+               t.total_amount, u.last_active
+        FROM users u
+        LEFT JOIN user_totals t ON t.user_id = u.user_id
+        ORDER BY u.last_active DESC
+    """,
+    #endregion
+
+    #region Итоги пользователя (user_totals)
+    "user_totals": """
+        SELECT expenses_count, total_amount, first_date, last_date
+        FROM user_totals WHERE user_id = $1
+    """,
+    "user_totals_count": "SELECT expenses_count FROM user_totals WHERE user_id = $1",
+    # После удаления первая и последняя даты могли измениться
+    "user_totals_refresh_dates": """
+        UPDATE user_totals SET
+            first_date = (SELECT MIN(date) FROM expenses WHERE user_id = $1),
+            last_date = (SELECT MAX(date) FROM expenses WHERE user_id = $1)
+        WHERE user_id = $1
+    """,
+    "user_totals_lock": "LOCK TABLE user_totals IN EXCLUSIVE MODE",
+    # Расхождения между user_totals и фактическими данными expenses
+    "user_totals_drift": """
+        WITH actual AS (
+            SELECT user_id, COUNT(*) AS expenses_count, SUM(amount) AS total_amount,
+                   MIN(date) AS first_date, MAX(date) AS last_date
+            FROM expenses
+            GROUP BY user_id
+        )
+        SELECT COALESCE(a.user_id, t.user_id) AS user_id,
+               t.expenses_count AS stored_count, a.expenses_count AS actual_count,
+               t.total_amount AS stored_amount, a.total_amount AS actual_amount
+        FROM actual a
+        FULL JOIN user_totals t ON t.user_id = a.user_id
+        WHERE (a.user_id IS NULL AND t.expenses_count <> 0)
+           OR t.user_id IS NULL
+           OR (t.expenses_count, t.total_amount, t.first_date, t.last_date)
+              IS DISTINCT FROM (a.expenses_count, a.total_amount, a.first_date, a.last_date)
+        ORDER BY 1
+    """,
+    "user_totals_rebuild": """
+        WITH actual AS (
+            SELECT user_id, COUNT(*) AS expenses_count, SUM(amount) AS total_amount,
+                   MIN(date) AS first_date, MAX(date) AS last_date
+            FROM expenses
+            GROUP BY user_id
+        ), cleared AS (
+            DELETE FROM user_totals t
+            WHERE NOT EXISTS (SELECT 1 FROM actual a WHERE a.user_id = t.user_id)
+        )
+        INSERT INTO user_totals (user_id, expenses_count, total_amount, first_date, last_date)
+        SELECT user_id, expenses_count, total_amount, first_date, last_date FROM actual
+        ON CONFLICT (user_id) DO UPDATE SET
+            expenses_count = EXCLUDED.expenses_count,
+            total_amount = EXCLUDED.total_amount,
+            first_date = EXCLUDED.first_date,
+            last_date = EXCLUDED.last_date
+    """,
+    #endregion
+
+    #region Расходы: запись и удаление
+    # Все строки одного сообщения вставляются одним запросом вместе с обновлением user_totals
+    "expenses_insert_bulk": """
+        WITH inserted AS (
+            INSERT INTO expenses (user_id, category, amount, date, time)
+            SELECT $1, r.category, r.amount, r.date, r.time
+            FROM unnest($2::text[], $3::numeric[], $4::date[], $5::time[])
+                 AS r(category, amount, date, time)
+            RETURNING amount, date, category
+        ), totals AS (
+            INSERT INTO user_totals (user_id, expenses_count, total_amount, first_date, last_date)
+            SELECT $1, COUNT(*), SUM(amount), MIN(date), MAX(date) FROM inserted
+            HAVING COUNT(*) > 0
+            ON CONFLICT (user_id) DO UPDATE SET
+                expenses_count = user_totals.expenses_count + EXCLUDED.expenses_count,
+                total_amount = user_totals.total_amount + EXCLUDED.total_amount,
+                first_date = LEAST(user_totals.first_date, EXCLUDED.first_date),
+                last_date = GREATEST(user_totals.last_date, EXCLUDED.last_date)
+        )
+        INSERT INTO expense_daily (user_id, date, category, total, count)
+        SELECT $1, date, category, SUM(amount), COUNT(*) FROM inserted
+        GROUP BY date, category
+        ON CONFLICT (user_id, date, category) DO UPDATE SET
+            total = expense_daily.total + EXCLUDED.total,
+            count = expense_daily.count + EXCLUDED.count
+    """,
+    "expense_duplicate_exists": """
+        SELECT 1 FROM expenses
+        WHERE user_id = $1 AND category = $2 AND amount = $3 AND date = $4
+          AND time IS NOT DISTINCT FROM $5
+        LIMIT 1
+    """,
+    "expenses_recent_for_delete": """
+        SELECT id, category, amount, date FROM expenses
+        WHERE user_id = $1 ORDER BY created_at DESC LIMIT $2
+    """,
+    "expenses_by_ids": """
+        SELECT id, category, amount, date FROM expenses
+        WHERE id = ANY($1::int[]) AND user_id = $2
+    """,
+    # Возвращает число удалённых записей. Затем в той же транзакции:
+    # user_totals_refresh_dates и expense_daily_prune
+    "expenses_delete_by_ids": """
+        WITH deleted AS (
+            DELETE FROM expenses WHERE id = ANY($1::int[]) AND user_id = $2
+            RETURNING amount, date, category
+        ), totals AS (
+            UPDATE user_totals SET
+                expenses_count = expenses_count - (SELECT COUNT(*) FROM deleted),
+                total_amount = total_amount - COALESCE((SELECT SUM(amount) FROM deleted), 0)
+            WHERE user_id = $2
+        ), daily AS (
+            UPDATE expense_daily d SET
+                total = d.total - x.total,
+                count = d.count - x.count
+            FROM (
+                SELECT date, category, SUM(amount) AS total, COUNT(*) AS count
+                FROM deleted GROUP BY date, category
+            ) x
+            WHERE d.user_id = $2 AND d.date = x.date AND d.category = x.category
+        )
+        SELECT COUNT(*) FROM deleted
+    """,
+    #endregion
+
+    #region История расходов
+    # Постраничный вывод по ключу (keyset): $2 — id граничной записи предыдущей страницы
+    "expenses_page_first": f"""
+        SELECT id, category, amount, date, time FROM expenses
+        WHERE user_id = $1
+        ORDER BY {_HISTORY_ORDER_DESC}
+        LIMIT $2
+    """,
+    "expenses_page_after": f"""
+        SELECT id, category, amount, date, time FROM expenses
+        WHERE user_id = $1 AND ({_HISTORY_KEY}) < ({_cursor_key("$2")})
+        ORDER BY {_HISTORY_ORDER_DESC}
+        LIMIT $3
+    """,
+    "expenses_page_before": f"""
+        SELECT id, category, amount, date, time FROM expenses
+        WHERE user_id = $1 AND ({_HISTORY_KEY}) > ({_cursor_key("$2")})
+        ORDER BY {_HISTORY_ORDER_ASC}
+        LIMIT $3
+    """,
+    "expenses_in_period": f"""
+        SELECT id, category, amount, date, time FROM expenses
+        WHERE user_id = $1 AND date BETWEEN $2 AND $3
+        ORDER BY {_HISTORY_ORDER_DESC}
+    """,
+    "expenses_category_count": """
+        SELECT COUNT(*) FROM expenses WHERE user_id = $1 AND category = $2
+    """,
+    "expenses_category_page_first": f"""
+        SELECT id, category, amount, date, time FROM expenses
+        WHERE user_id = $1 AND category = $2
+        ORDER BY {_HISTORY_ORDER_DESC}
+        LIMIT $3
+    """,
+    # Категория берётся из граничной записи, поэтому в callback_data её передавать не нужно
+    "expenses_category_page_after": f"""
+        SELECT id, category, amount, date, time FROM expenses
+        WHERE user_id = $1
+          AND category = (SELECT category FROM expenses WHERE id = $2 AND user_id = $1)
+          AND ({_HISTORY_KEY}) < ({_cursor_key("$2")})
+        ORDER BY {_HISTORY_ORDER_DESC}
+        LIMIT $3
+    """,
+    "expenses_category_page_before": f"""
+        SELECT id, category, amount, date, time FROM expenses
+        WHERE user_id = $1
+          AND category = (SELECT category FROM expenses WHERE id = $2 AND user_id = $1)
+          AND ({_HISTORY_KEY}) > ({_cursor_key("$2")})
+        ORDER BY {_HISTORY_ORDER_ASC}
+        LIMIT $3
+    """,
+    "expenses_category_all": f"""
+        SELECT id, amount, date, time FROM expenses
+        WHERE user_id = $1 AND category = $2
+        ORDER BY {_HISTORY_ORDER_DESC}
+    """,
+    # Поиск (параметры $2–$5 — см. _SEARCH_FILTER): id всех совпадений по релевантности,
+    # не больше $6. Страницы затем читаются по id через expenses_by_ids_ordered.
+    "expenses_search_ids": f"""
+        SELECT id FROM expenses
+        WHERE user_id = $1 AND {_SEARCH_FILTER}
+        ORDER BY {_SEARCH_ORDER_DESC}
+        LIMIT $6
+    """,
+    # Записи в порядке переданных id (удалённые пропускаются)
+    "expenses_by_ids_ordered": """
+        SELECT e.id, e.category, e.amount, e.date, e.time
+        FROM unnest($1::int[]) WITH ORDINALITY AS s(id, ord)
+        JOIN expenses e ON e.id = s.id AND e.user_id = $2
+        ORDER BY s.ord
+    """,
+    #endregion
+
+    #region Категории
+    "user_categories_list": "SELECT category FROM user_categories WHERE user_id = $1",
+    "user_categories_count": "SELECT COUNT(*) FROM user_categories WHERE user_id = $1",
+    "user_category_exists_ci": """
+        SELECT 1 FROM user_categories WHERE user_id = $1 AND LOWER(category) = LOWER($2)
+    """,
+    "user_category_insert": "INSERT INTO user_categories (user_id, category) VALUES ($1, $2)",
+    "user_category_delete": "DELETE FROM user_categories WHERE user_id = $1 AND category = $2",
+    "user_category_rename": """
+        UPDATE user_categories SET category = $3 WHERE user_id = $1 AND category = $2
+    """,
+    "expense_categories_used": """
+        SELECT DISTINCT category FROM expenses WHERE user_id = $1 ORDER BY category
+    """,
+    "expenses_rename_category": """
+        UPDATE expenses SET category = $3 WHERE user_id = $1 AND category = $2
+    """,
+    #endregion
+
+    #region Суммы по дням и категориям (expense_daily)
+    "expense_daily_prune": "DELETE FROM expense_daily WHERE user_id = $1 AND count <= 0",
+    # Переносит суммы категории $2 в категорию $3 (переименование и удаление категории)
+    "expense_daily_rename_category": """
+        WITH moved AS (
+            DELETE FROM expense_daily WHERE user_id = $1 AND category = $2
+            RETURNING date, total, count
+        )
+        INSERT INTO expense_daily (user_id, date, category, total, count)
+        SELECT $1, date, $3, total, count FROM moved
+        ON CONFLICT (user_id, date, category) DO UPDATE SET
+            total = expense_daily.total + EXCLUDED.total,
+            count = expense_daily.count + EXCLUDED.count
+    """,
+    # Пересборка из expenses: $1 — user_id или NULL для всех пользователей
+    "expense_daily_clear": """
+        DELETE FROM expense_daily WHERE $1::bigint IS NULL OR user_id = $1
+    """,
+    "expense_daily_backfill": """
+        INSERT INTO expense_daily (user_id, date, category, total, count)
+        SELECT user_id, date, category, SUM(amount), COUNT(*)
+        FROM expenses
+        WHERE $1::bigint IS NULL OR user_id = $1
+        GROUP BY user_id, date, category
+    """,
+    "expense_daily_lock": "LOCK TABLE expense_daily IN EXCLUSIVE MODE",
+    #endregion
+
+    #region Состояния FSM (fsm_storage)
+    "fsm_get": """
+        SELECT state, data::text AS data FROM fsm_storage
+        WHERE key = $1 AND updated_at > CURRENT_TIMESTAMP - make_interval(days => $2)
+    """,
+    "fsm_upsert_many": """
+        INSERT INTO fsm_storage (key, state, data, updated_at)
+        SELECT r.key, r.state, r.data::jsonb, CURRENT_TIMESTAMP
+        FROM unnest($1::text[], $2::text[], $3::text[]) AS r(key, state, data)
+        ON CONFLICT (key) DO UPDATE SET
+            state = EXCLUDED.state,
+            data = EXCLUDED.data,
+            updated_at = EXCLUDED.updated_at
+    """,
+    "fsm_delete_expired": """
+        DELETE FROM fsm_storage
+        WHERE updated_at < CURRENT_TIMESTAMP - make_interval(days => $1)
+    """,
+    #endregion
+
+    #region Статистика ($2/$3 — границы периода, для «всё время» это date.min/date.max)
+    # Читает expense_daily: не больше одной строки на категорию за каждый активный день.
+    # ROLLUP добавляет строку общего итога (is_total = 1), она идёт первой.
+    "stats_by_category": """
+        SELECT category, GROUPING(category) AS is_total,
+               SUM(count) AS count, SUM(total) AS total
+        FROM expense_daily
+        WHERE user_id = $1 AND date BETWEEN $2 AND $3
+        GROUP BY ROLLUP (category)
+        ORDER BY is_total DESC, total DESC
+    """,
+    #endregion
+}
@@ -6,9 +6,11 @@ from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import CallbackQuery
+from collections import OrderedDict
 
 from init import logging, ADMIN_ID
 from db.db_main import get_pool
+from expense.changes import notify_expenses_changed
 
 category_router = Router()
 
@@ -24,41 +26,81 @@ class ExpenseStates(StatesGroup):
     waiting_for_new_category = State()  # ← новое состояние
     waiting_for_edit_category = State()
 
+#region Кэш категорий
+CATEGORY_CACHE_MAX_SIZE = 10_000  # сколько пользователей держим в кэше категорий
+
+# user_id -> {"custom", "available", "lookup", "used"}; порядок = LRU.
+# Сбрасывается обработчиками добавления, изменения и удаления категорий.
+_category_cache: OrderedDict[int, dict] = OrderedDict()
+
+def invalidate_user_categories(user_id: int):
+    """Сбрасывает кэш категорий пользователя после изменений"""
+    _category_cache.pop(user_id, None)
+
+def mark_categories_used(user_id: int, categories):
+    """Отмечает категории как использованные в расходах, не обращаясь к БД"""
+    entry = _category_cache.get(user_id)
+    if entry is not None and entry["used"] is not None:
+        entry["used"].update(categories)
+
+async def _get_category_entry(user_id: int) -> dict:
+    entry = _category_cache.get(user_id)
+    if entry is not None:
+        _category_cache.move_to_end(user_id)
+        return entry
+
+    pool = get_pool()
+    # Получаем пользовательские категории из user_categories
+    user_custom = await pool.fetch_named("user_categories_list", user_id)
+    custom = [r['category'] for r in user_custom]
+
+    if user_id == ADMIN_ID:
+        # У администратора сначала кастомные, потом предустановленные
+        available = custom + PREDEFINED_CATEGORIES
+    else:
+        # У обычных — сначала предустановленные, потом кастомные
+        available = PREDEFINED_CATEGORIES + custom
+
+    # При совпадении без учёта регистра побеждает первая категория в списке
+    lookup = {}
+    for cat in available:
+        lookup.setdefault(cat.lower(), cat)
+
+    entry = {"custom": custom, "available": available, "lookup": lookup, "used": None}
+    _category_cache[user_id] = entry
+    while len(_category_cache) > CATEGORY_CACHE_MAX_SIZE:
+        _category_cache.popitem(last=False)
+    return entry
+
+async def _get_used_categories(user_id: int) -> set[str]:
+    entry = await _get_category_entry(user_id)
+    if entry["used"] is None:
+        pool = get_pool()
+        used = await pool.fetch_named("expense_categories_used", user_id)
+        entry["used"] = {row['category'] for row in used}
+    return entry["used"]
+#endregion
 #region Получение категорий
 async def get_available_categories(user_id: int) -> list[str]:
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        # Получаем пользовательские категории из user_categories
-        user_custom = await conn.fetch(
-            "SELECT category FROM user_categories WHERE user_id = $1",
-            user_id
-        )
-        custom = [r['category'] for r in user_custom]
+    entry = await _get_category_entry(user_id)
+    return entry["available"]
 
-        if user_id == ADMIN_ID:
-            # У администратора сначала кастомные, потом предустановленные
-            return custom + PREDEFINED_CATEGORIES
-        else:
-            # У обычных — сначала предустановленные, потом кастомные
-            return PREDEFINED_CATEGORIES + custom
+async def get_category_lookup(user_id: int) -> dict[str, str]:
+    """Возвращает словарь «название в нижнем регистре -> категория»"""
+    entry = await _get_category_entry(user_id)
+    return entry["lookup"]
+
+async def get_custom_categories(user_id: int) -> list[str]:
+    entry = await _get_category_entry(user_id)
+    return entry["custom"]
 
 async def get_user_categories(user_id: int) -> list[str]:
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        # Получаем категории из user_categories (все добавленные пользователем)
-        user_categories = await conn.fetch(
-            "SELECT category FROM user_categories WHERE user_id = $1",
-            user_id
-        )
-        # И категории, которые уже использовались в расходах
-        used_categories = await conn.fetch(
-            "SELECT DISTINCT category FROM expenses WHERE user_id = $1",
-            user_id
-        )
-        
-        # Объединяем и убираем дубликаты
-        all_categories = {row['category'] for row in user_categories} | {row['category'] for row in used_categories}
-        return list(all_categories)
+    # Категории из user_categories (все добавленные пользователем)
+    # и категории, которые уже использовались в расходах
+    custom = await get_custom_categories(user_id)
+    used = await _get_used_categories(user_id)
+    # Объединяем и убираем дубликаты
+    return list(set(custom) | used)
 #endregion
 #region Меню категорий
 @category_router.callback_query(F.data == "categories")
@@ -122,10 +164,7 @@ async def save_new_category(message: types.Message, state: FSMContext):
     pool = get_pool()
     async with pool.acquire() as conn:
         # Проверяем, сколько у пользователя кастомных категорий
-        count_custom = await conn.fetchval(
-            "SELECT COUNT(*) FROM user_categories WHERE user_id = $1",
-            user_id
-        )
+        count_custom = await conn.fetchval_named("user_categories_count", user_id)
 
         if user_id != ADMIN_ID and count_custom >= MAX_CUSTOM_CATEGORIES:
             await message.answer("❌ Вы достигли лимита из 5 пользовательских категорий.")
@@ -133,20 +172,15 @@ async def save_new_category(message: types.Message, state: FSMContext):
             return
 
         # Проверяем, есть ли такая категория уже у пользователя
-        exists = await conn.fetchval(
-            "SELECT 1 FROM user_categories WHERE user_id = $1 AND LOWER(category) = LOWER($2)",
-            user_id, new_cat
-        )
+        exists = await conn.fetchval_named("user_category_exists_ci", user_id, new_cat)
         if exists:
             await message.answer("❌ Такая категория уже существует.")
             await state.clear()
             return
 
         # Добавляем новую категорию в user_categories
-        await conn.execute(
-            "INSERT INTO user_categories (user_id, category) VALUES ($1, $2)",
-            user_id, new_cat
-        )
+        await conn.execute_named("user_category_insert", user_id, new_cat)
+    invalidate_user_categories(user_id)
     # Клавиатура с кнопкой "Добавить расходы"
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -185,21 +219,9 @@ async def add_category_prompt(call: CallbackQuery, state: FSMContext):
 #region Удаление категории
 @category_router.callback_query(F.data == "delete_category")
 async def delete_category_menu(call: CallbackQuery):
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        # Получаем все пользовательские категории
-        user_categories = await conn.fetch(
-            "SELECT category FROM user_categories WHERE user_id = $1",
-            call.from_user.id
-        )
-        # Получаем категории, которые уже использовались в расходах
-        used_categories = await conn.fetch(
-            "SELECT DISTINCT category FROM expenses WHERE user_id = $1",
-            call.from_user.id
-        )
-    
-    custom_categories = [row['category'] for row in user_categories]
-    used_categories_set = {row['category'] for row in used_categories}
+    # Все пользовательские категории и категории, которые уже использовались в расходах
+    custom_categories = await get_custom_categories(call.from_user.id)
+    used_categories_set = await _get_used_categories(call.from_user.id)
     
     if not custom_categories:
         await call.answer("❌ У вас нет пользовательских категорий для удаления", show_alert=True)
@@ -260,17 +282,15 @@ async def execute_delete_category(call: CallbackQuery):
     
     pool = get_pool()
     async with pool.acquire() as conn:
-        # Удаляем категорию из пользовательских
-        await conn.execute(
-            "DELETE FROM user_categories WHERE user_id = $1 AND category = $2",
-            user_id, category
-        )
-        
-        # Обновляем расходы с этой категорией на "Другое"
-        await conn.execute(
-            "UPDATE expenses SET category = 'Другое' WHERE user_id = $1 AND category = $2",
-            user_id, category
-        )
+        async with conn.transaction():
+            # Удаляем категорию из пользовательских
+            await conn.execute_named("user_category_delete", user_id, category)
+
+            # Обновляем расходы с этой категорией на "Другое"
+            await conn.execute_named("expenses_rename_category", user_id, category, "Другое")
+            await conn.execute_named("expense_daily_rename_category", user_id, category, "Другое")
+    invalidate_user_categories(user_id)
+    notify_expenses_changed(user_id)
     
     await call.answer(f"Категория '{category}' удалена", show_alert=True)
     await categories_menu(call, None)
@@ -347,26 +367,21 @@ async def save_edited_category(message: types.Message, state: FSMContext):
     pool = get_pool()
     async with pool.acquire() as conn:
         # Проверяем, есть ли уже такая категория
-        exists = await conn.fetchval(
-            "SELECT 1 FROM user_categories WHERE user_id = $1 AND LOWER(category) = LOWER($2)",
-            user_id, new_category
-        )
+        exists = await conn.fetchval_named("user_category_exists_ci", user_id, new_category)
         if exists:
             await message.answer("❌ Такая категория уже существует")
             await state.clear()
             return
         
-        # Обновляем категорию в user_categories
-        await conn.execute(
-            "UPDATE user_categories SET category = $1 WHERE user_id = $2 AND category = $3",
-            new_category, user_id, old_category
-        )
-        
-        # Обновляем категорию в expenses
-        await conn.execute(
-            "UPDATE expenses SET category = $1 WHERE user_id = $2 AND category = $3",
-            new_category, user_id, old_category
-        )
+        async with conn.transaction():
+            # Обновляем категорию в user_categories
+            await conn.execute_named("user_category_rename", user_id, old_category, new_category)
+
+            # Обновляем категорию в expenses
+            await conn.execute_named("expenses_rename_category", user_id, old_category, new_category)
+            await conn.execute_named("expense_daily_rename_category", user_id, old_category, new_category)
+    invalidate_user_categories(user_id)
+    notify_expenses_changed(user_id)
     
     await message.answer(f"✅ Категория изменена с «{old_category}» на «{new_category}»")
     await state.clear()
@@ -0,0 +1,25 @@
+from typing import Callable
+
+from init import logging
+
+# Версия данных о расходах каждого пользователя. Увеличивается при любом изменении
+# (добавление, удаление, переименование категории), по ней строятся ключи кэшей.
+_data_versions: dict[int, int] = {}
+_listeners: list[Callable[[int], None]] = []
+
+def get_data_version(user_id: int) -> int:
+    return _data_versions.get(user_id, 0)
+
+def on_expenses_changed(listener: Callable[[int], None]):
+    """Регистрирует функцию сброса кэша, вызываемую с user_id при изменениях"""
+    _listeners.append(listener)
+    return listener
+
+def notify_expenses_changed(user_id: int):
+    """Сообщает кэшам, что расходы пользователя изменились"""
+    _data_versions[user_id] = _data_versions.get(user_id, 0) + 1
+    for listener in _listeners:
+        try:
+            listener(user_id)
+        except Exception as e:
+            logging.error("❌ Ошибка при сбросе кэша для пользователя %s: %s", user_id, e)
@@ -9,6 +9,8 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import asyncpg  # для работы с базой данных
 from init import logging  # твой модуль для логов
 from db.db_main import get_pool  # функция для получения пула подключения к базе
+from expense.category import invalidate_user_categories
+from expense.changes import notify_expenses_changed
 
 # Создаем роутер для обработки удаления расходов
 expense_delete_router = Router()
@@ -31,11 +33,7 @@ async def delete_expense_start(user_id: int, message: types.Message, state: FSMC
     pool = get_pool()
 
     try:
-        expenses = await pool.fetch(
-            "SELECT id, category, amount, date FROM expenses "
-            "WHERE user_id = $1 ORDER BY created_at DESC LIMIT 5",
-            user_id
-        )
+        expenses = await pool.fetch_named("expenses_recent_for_delete", user_id, 5)
 
         if not expenses:
             await message.answer("Нет последних записей для удаления.")
@@ -61,7 +59,7 @@ async def delete_expense_start(user_id: int, message: types.Message, state: FSMC
         await state.set_state(DeleteExpenseStates.waiting_for_delete_id)
 
     except asyncpg.PostgresError as e:
-        logging.error(f"Database error: {e}")
+        logging.error("Database error: %s", e)
         await message.answer("❌ Ошибка при получении данных из базы данных.")
 
 @expense_delete_router.message(DeleteExpenseStates.waiting_for_delete_id)
@@ -86,18 +84,14 @@ async def process_delete_expense(message: types.Message, state: FSMContext):
     db_pool = get_pool()
 
     # Проверяем, что все записи существуют и принадлежат пользователю
-    rows = await db_pool.fetch(
-        "SELECT id, category, amount, date FROM expenses WHERE id = ANY($1) AND user_id = $2",
-        expense_ids,
-        message.from_user.id
-    )
+    rows = await db_pool.fetch_named("expenses_by_ids", expense_ids, message.from_user.id)
 
     if not rows or len(rows) != len(expense_ids):
         await message.answer("❌ Некоторые записи не найдены или не принадлежат вам. Проверьте список ID.")
         return
 
-    # Сохраняем ID и детали для подтверждения
-    await state.update_data(expense_ids=expense_ids, expense_rows=rows)
+    # Сохраняем ID для подтверждения (данные FSM хранятся в БД в виде JSON)
+    await state.update_data(expense_ids=expense_ids)
 
     # Формируем список для подтверждения
     expenses_list = "\n".join(
@@ -132,19 +126,26 @@ async def confirm_delete_callback(call: types.CallbackQuery, state: FSMContext):
 
         db_pool = get_pool()
         try:
-            result = await db_pool.execute(
-                "DELETE FROM expenses WHERE id = ANY($1) AND user_id = $2",
-                expense_ids,
-                call.from_user.id
-            )
-            # result возвращает строку вида "DELETE X"
-            count_deleted = int(result.split()[1])
+            # Удаление и пересчёт user_totals — в одной транзакции
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    count_deleted = await conn.fetchval_named(
+                        "expenses_delete_by_ids",
+                        expense_ids,
+                        call.from_user.id
+                    )
+                    if count_deleted:
+                        await conn.execute_named("user_totals_refresh_dates", call.from_user.id)
+                        await conn.execute_named("expense_daily_prune", call.from_user.id)
             if count_deleted == 0:
                 await call.message.answer("❌ Записи не найдены или уже удалены")
             else:
+                # Категория могла перестать использоваться в расходах
+                invalidate_user_categories(call.from_user.id)
+                notify_expenses_changed(call.from_user.id)
                 await call.message.edit_text(f"✅ Успешно удалено {count_deleted} записей")
         except asyncpg.PostgresError as e:
-            logging.error(f"Database error: {e}")
+            logging.error("Database error: %s", e)
             await call.message.answer("❌ Ошибка при удалении записей из базы данных")
 
         await state.clear()
@@ -9,12 +9,19 @@ from aiogram.types import (
     CallbackQuery
 )
 from datetime import timedelta, date, datetime
+import time
 from init import logging 
 from db.db_main import get_pool
+from expense.changes import on_expenses_changed
 
 expense_history_router = Router()
 
 EXPENSES_PER_PAGE = 5  # Количество расходов на одной странице
+HISTORY_TOTALS_TTL = 60  # секунд хранения числа записей для заголовков страниц
+HISTORY_TOTALS_MAX_USERS = 10_000
+SEARCH_SNAPSHOT_TTL = 600  # секунд хранения результатов поиска для листания
+SEARCH_SNAPSHOT_MAX_IDS = 1000  # больше совпадений не листаем
+SEARCH_SNAPSHOT_MAX_USERS = 10_000
 
 class SearchExpenses(StatesGroup):
     waiting_for_query = State()
@@ -22,6 +29,89 @@ class PeriodHistory(StatesGroup):
     waiting_for_custom_period = State()
 
 #endregion
+#region Постраничный вывод (keyset)
+# user_id -> {область: (число записей, время истечения)}
+_history_totals: dict[int, dict] = {}
+
+@on_expenses_changed
+def invalidate_history_totals(user_id: int):
+    """Сбрасывает закэшированные количества записей пользователя"""
+    _history_totals.pop(user_id, None)
+
+async def _get_history_total(user_id: int, scope, query_name: str, *params) -> int:
+    """Число записей для заголовка страницы; считается не чаще раза в HISTORY_TOTALS_TTL"""
+    scopes = _history_totals.get(user_id)
+    if scopes is None:
+        if len(_history_totals) >= HISTORY_TOTALS_MAX_USERS:
+            _history_totals.clear()
+        scopes = _history_totals[user_id] = {}
+
+    cached = scopes.get(scope)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    total = await get_pool().fetchval_named(query_name, *params) or 0
+    scopes[scope] = (total, time.monotonic() + HISTORY_TOTALS_TTL)
+    return total
+
+async def _fetch_keyset_page(prefix: str, params: list, direction: str | None, cursor_id: int | None,
+                             page: int, cursor_params: list | None = None):
+    """Загружает страницу относительно граничной записи.
+
+    direction: None — первая страница, "n" — после cursor_id, "p" — перед cursor_id.
+    cursor_params — параметры запросов листания, если они отличаются от params.
+    Возвращает (записи, есть_предыдущая, есть_следующая, номер_страницы).
+    """
+    pool = get_pool()
+    limit = EXPENSES_PER_PAGE + 1  # лишняя запись показывает, есть ли продолжение
+    if cursor_params is None:
+        cursor_params = params
+
+    if direction == "n":
+        rows = await pool.fetch_named(f"{prefix}_after", *cursor_params, cursor_id, limit)
+    elif direction == "p":
+        rows = await pool.fetch_named(f"{prefix}_before", *cursor_params, cursor_id, limit)
+    else:
+        rows = []
+
+    if not rows:
+        # Первая страница, либо граничная запись была удалена
+        direction, page = None, 1
+        rows = await pool.fetch_named(f"{prefix}_first", *params, limit)
+
+    has_more = len(rows) > EXPENSES_PER_PAGE
+    rows = rows[:EXPENSES_PER_PAGE]
+
+    if direction == "p":
+        if has_more and page <= 1:
+            # Выше граничной записи появились новые: нумерация сбилась, начинаем с первой страницы
+            rows = await pool.fetch_named(f"{prefix}_first", *params, limit)
+            return rows[:EXPENSES_PER_PAGE], False, len(rows) > EXPENSES_PER_PAGE, 1
+        rows = rows[::-1]
+        if not has_more:
+            page = 1
+        return rows, has_more, True, page
+
+    page = max(page, 1)
+    return rows, page > 1, has_more, page
+
+def _add_nav_buttons(builder: InlineKeyboardBuilder, nav_prefix: str, rows, page: int,
+                     has_prev: bool, has_next: bool):
+    # Формат: {nav_prefix}_{n|p}_{id граничной записи}_{страница}
+    if has_prev:
+        builder.button(text="⬅️ Назад", callback_data=f"{nav_prefix}_p_{rows[0]['id']}_{page - 1}")
+    if has_next:
+        builder.button(text="Вперед ➡️", callback_data=f"{nav_prefix}_n_{rows[-1]['id']}_{page + 1}")
+
+def _parse_nav(data: str, nav_prefix: str):
+    """Разбирает callback_data кнопок листания: (направление, id, страница)"""
+    direction, cursor_id, page = data[len(nav_prefix) + 1:].split("_", 2)
+    return direction, int(cursor_id), int(page)
+
+def _total_pages(total: int, page: int) -> int:
+    # Количество может немного отставать от данных, номер страницы важнее
+    return max((total - 1) // EXPENSES_PER_PAGE + 1, page, 1)
+#endregion
 #region История расходов
 @expense_history_router.callback_query(F.data == "expenses_history")
 async def expenses_history_menu(call: CallbackQuery):
@@ -48,40 +138,29 @@ async def expenses_history_menu(call: CallbackQuery):
 @expense_history_router.callback_query(F.data == "expenses_recent")
 async def show_history_start(call: CallbackQuery):
     # Показываем первую страницу
-    await show_expenses_page(call.message, call.from_user.id, 1)
+    await show_expenses_page(call.message, call.from_user.id)
     await call.answer()  # добавим call.answer() чтобы убрать "часики"
 
-@expense_history_router.callback_query(F.data.startswith("expenses_page_")) # Обработчик callback-запросов для пагинации
+@expense_history_router.callback_query(F.data.startswith("expenses_nav_")) # Обработчик callback-запросов для пагинации
 async def paginate_expenses(call: CallbackQuery):
-    page = int(call.data.split("_")[-1])
-    await show_expenses_page(call.message, call.from_user.id, page)
+    direction, cursor_id, page = _parse_nav(call.data, "expenses_nav")
+    await show_expenses_page(call.message, call.from_user.id, direction, cursor_id, page)
     await call.answer()
 
-async def show_expenses_page(message: types.Message, user_id: int, page: int):
-    pool = get_pool()
+async def show_expenses_page(message: types.Message, user_id: int,
+                             direction: str | None = None, cursor_id: int | None = None, page: int = 1):
     try:
-        total_expenses = await pool.fetchval(
-            "SELECT COUNT(*) FROM expenses WHERE user_id = $1",
-            user_id
-        ) or 0
-        
-        total_pages = max((total_expenses - 1) // EXPENSES_PER_PAGE + 1, 1)
-        
-        expenses = await pool.fetch(
-            "SELECT id, category, amount, date, time FROM expenses "
-            "WHERE user_id = $1 "
-            "ORDER BY date DESC, (time IS NULL), time DESC, created_at DESC "
-            "LIMIT $2 OFFSET $3",
-            user_id,
-            EXPENSES_PER_PAGE,
-            (page - 1) * EXPENSES_PER_PAGE
+        expenses, has_prev, has_next, page = await _fetch_keyset_page(
+            "expenses_page", [user_id], direction, cursor_id, page
         )
 
-        
         if not expenses:
             await message.answer("📭 У вас пока нет записей о расходах")
             return
-            
+
+        total_expenses = await _get_history_total(user_id, "all", "user_totals_count", user_id)
+        total_pages = _total_pages(total_expenses, page)
+
         text = (
             f"📝 <b>История расходов</b> (страница {page}/{total_pages})\n"
             f"📊 Всего записей: <b>{total_expenses}</b>\n\n"
@@ -97,19 +176,14 @@ async def show_expenses_page(message: types.Message, user_id: int, page: int):
             )
         
         builder = InlineKeyboardBuilder()
-        
-        if page > 1:
-            builder.button(text="⬅️ Назад", callback_data=f"expenses_page_{page-1}")
-        if page < total_pages:
-            builder.button(text="Вперед ➡️", callback_data=f"expenses_page_{page+1}")
-        
+        _add_nav_buttons(builder, "expenses_nav", expenses, page, has_prev, has_next)
         builder.button(text="🔙 В меню", callback_data="main_menu")
         builder.adjust(2)
         
         await message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
 
     except Exception as e:
-        logging.error(f"Ошибка при получении истории расходов: {e}")
+        logging.error("Ошибка при получении истории расходов: %s", e)
         await message.answer("❌ Не удалось загрузить историю расходов")
 
 #endregion
@@ -177,7 +251,7 @@ async def handle_custom_period(message: Message, state: FSMContext):
         await state.clear()
 
     except Exception as e:
-        logging.warning(f"Ошибка при парсинге периода: {e}")
+        logging.warning("Ошибка при парсинге периода: %s", e)
         await message.answer("❌ Неверный формат. Введите, например:\n<code>13.11.2024 - 22.05</code>",
                              parse_mode=ParseMode.HTML)
 
@@ -185,12 +259,7 @@ async def handle_custom_period(message: Message, state: FSMContext):
 async def show_expenses_in_period(message: types.Message, user_id: int, start_date: date, end_date: date):
     pool = get_pool()
     try:
-        expenses = await pool.fetch(
-            "SELECT id, category, amount, date, time FROM expenses "
-            "WHERE user_id = $1 AND date BETWEEN $2 AND $3 "
-            "ORDER BY date DESC, (time IS NULL), time DESC, created_at DESC",
-            user_id, start_date, end_date
-        )
+        expenses = await pool.fetch_named("expenses_in_period", user_id, start_date, end_date)
 
         if not expenses:
             await message.answer("📭 За этот период нет записей о расходах.")
@@ -218,7 +287,7 @@ async def show_expenses_in_period(message: types.Message, user_id: int, start_da
         await message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
     
     except Exception as e:
-        logging.error(f"Ошибка показа расходов за период: {e}")
+        logging.error("Ошибка показа расходов за период: %s", e)
         await message.answer("❌ Не удалось загрузить данные.")
 #endregion
 #region Поиск расходов
@@ -236,79 +305,73 @@ async def process_search_query(message: Message, state: FSMContext):
     query = message.text.strip()
     user_id = message.from_user.id
 
-    # Сохраним запрос и сбросим страницу на 1
-    await state.update_data(search_query=query, page=1)
+    # Выходим из режима ввода, но запрос оставляем в данных — по нему
+    # пересчитаем результаты, если снимок устареет во время листания
+    await state.set_state(None)
+    await state.update_data(search_query=query)
 
-    await show_search_results(message, user_id, query, 1)
+    await show_search_results(message, user_id, query)
 
-    await state.clear()  # если не нужна пагинация по страницам, иначе не очищать
+# user_id -> (запрос, id совпадений по релевантности, время истечения)
+_search_snapshots: dict[int, tuple[str, list[int], float]] = {}
 
-async def show_search_results(message: Message, user_id: int, query: str, page: int):
-    pool = get_pool()
+@on_expenses_changed
+def invalidate_search_snapshot(user_id: int):
+    """Сбрасывает снимок поиска: при листании он пересчитается по сохранённому запросу"""
+    _search_snapshots.pop(user_id, None)
+
+def _search_params(user_id: int, query: str) -> list:
+    # Попытка распарсить дату
+    date_filter = None
     try:
-        params = [user_id]
-        conditions = ["user_id = $1"]
-        idx = 2
-
-        # Попытка распарсить дату
-        date_filter = None
-        try:
-            date_filter = datetime.strptime(query, "%d.%m.%Y").date()
-        except:
-            pass
-
-        # Попытка распарсить сумму
-        amount_filter = None
-        try:
-            amount_filter = float(query.replace(",", "."))
-        except:
-            pass
-
-        or_conditions = []
-        if date_filter:
-            or_conditions.append(f"date = ${idx}")
-            params.append(date_filter)
-            idx += 1
-
-        if amount_filter is not None:
-            or_conditions.append(f"(amount >= ${idx} AND amount < ${idx + 1})")
-            params.append(amount_filter)
-            params.append(amount_filter + 1)
-            idx += 2
-
-        or_conditions.append(f"category ILIKE ${idx}")
-        params.append(f"%{query}%")
-        idx += 1
-
-        # Формируем часть с OR
-        or_sql = " OR ".join(or_conditions)
-
-        # Собираем полный WHERE
-        where_sql = " AND ".join(conditions + [f"({or_sql})"])
-
-        # Подсчёт общего количества записей
-        count_sql = f"SELECT COUNT(*) FROM expenses WHERE {where_sql}"
-        total_expenses = await pool.fetchval(count_sql, *params)
-
-        if total_expenses == 0:
-            await message.answer("❌ По вашему запросу ничего не найдено.")
-            return
+        date_filter = datetime.strptime(query, "%d.%m.%Y").date()
+    except:
+        pass
 
-        total_pages = max((total_expenses - 1) // EXPENSES_PER_PAGE + 1, 1)
-        offset = (page - 1) * EXPENSES_PER_PAGE
+    # Попытка распарсить сумму
+    amount_from = amount_to = None
+    try:
+        amount_from = float(query.replace(",", "."))
+        amount_to = amount_from + 1
+    except:
+        pass
+
+    # Неиспользуемые условия передаются как NULL и не срабатывают;
+    # текст сравнивается с категорией по подстроке и по похожести (pg_trgm)
+    return [user_id, date_filter, amount_from, amount_to, query]
+
+async def _get_search_snapshot(user_id: int, query: str) -> list[int]:
+    """id найденных записей: поиск выполняется один раз, страницы берутся из снимка"""
+    cached = _search_snapshots.get(user_id)
+    if cached and cached[0] == query and cached[2] > time.monotonic():
+        return cached[1]
+
+    rows = await get_pool().fetch_named(
+        "expenses_search_ids", *_search_params(user_id, query), SEARCH_SNAPSHOT_MAX_IDS
+    )
+    ids = [row['id'] for row in rows]
+    if len(_search_snapshots) >= SEARCH_SNAPSHOT_MAX_USERS:
+        _search_snapshots.clear()
+    _search_snapshots[user_id] = (query, ids, time.monotonic() + SEARCH_SNAPSHOT_TTL)
+    return ids
 
-        query_sql = (
-            f"SELECT id, category, amount, date, time FROM expenses "
-            f"WHERE {where_sql} "
-            f"ORDER BY date DESC, (time IS NULL), time DESC, created_at DESC "
-            f"LIMIT {EXPENSES_PER_PAGE} OFFSET {offset}"
-        )
+async def show_search_results(message: Message, user_id: int, query: str, page: int = 1):
+    try:
+        ids = await _get_search_snapshot(user_id, query)
+        if not ids:
+            await message.answer("❌ По вашему запросу ничего не найдено.")
+            return
 
-        expenses = await pool.fetch(query_sql, *params)
+        total_expenses = len(ids)
+        total_pages = _total_pages(total_expenses, 1)
+        page = min(max(page, 1), total_pages)
+        page_ids = ids[(page - 1) * EXPENSES_PER_PAGE:page * EXPENSES_PER_PAGE]
+        expenses = await get_pool().fetch_named("expenses_by_ids_ordered", page_ids, user_id)
 
+        total_text = f"{total_expenses}+" if total_expenses >= SEARCH_SNAPSHOT_MAX_IDS else str(total_expenses)
         text = (
             f"🔍 <b>Результаты поиска</b> (страница {page}/{total_pages})\n"
-            f"📊 Всего найдено: <b>{total_expenses}</b>\n\n"
+            f"📊 Всего найдено: <b>{total_text}</b>\n\n"
         )
 
         for i, expense in enumerate(expenses, 1):
@@ -321,34 +384,38 @@ async def show_search_results(message: Message, user_id: int, query: str, page:
             )
 
         builder = InlineKeyboardBuilder()
+        # Формат: search_page_{страница}; сам запрос хранится в состоянии FSM
         if page > 1:
-            builder.button(text="⬅️ Назад", callback_data=f"search_expenses_page_{page-1}_{query}")
+            builder.button(text="⬅️ Назад", callback_data=f"search_page_{page - 1}")
         if page < total_pages:
-            builder.button(text="Вперед ➡️", callback_data=f"search_expenses_page_{page+1}_{query}")
+            builder.button(text="Вперед ➡️", callback_data=f"search_page_{page + 1}")
         builder.button(text="🔙 В меню", callback_data="main_menu")
         builder.adjust(2)
 
         await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
 
     except Exception as e:
-        logging.error(f"Ошибка поиска расходов: {e}")
+        logging.error("Ошибка поиска расходов: %s", e)
         await message.answer("❌ Произошла ошибка при поиске расходов.")
 
 
-@expense_history_router.callback_query(F.data.startswith("search_expenses_page_"))
-async def paginate_search_expenses(call: CallbackQuery):
-    # Данные формата: search_expenses_page_{page}_{query}
+@expense_history_router.callback_query(F.data.startswith("search_page_"))
+async def paginate_search_expenses(call: CallbackQuery, state: FSMContext):
     try:
-        _, _, page_str, *query_parts = call.data.split("_")
-        page = int(page_str)
-        query = "_".join(query_parts)  # т.к. query может содержать _
-        user_id = call.from_user.id
+        page = int(call.data[len("search_page_"):])
+        query = (await state.get_data()).get("search_query")
+        if not query and call.from_user.id in _search_snapshots:
+            # Состояние сбросил другой сценарий, но снимок поиска ещё жив
+            query = _search_snapshots[call.from_user.id][0]
+        if not query:
+            await call.answer("⌛ Результаты поиска устарели, повторите поиск.", show_alert=True)
+            return
 
         # Показываем результаты на нужной странице
-        await show_search_results(call.message, user_id, query, page)
+        await show_search_results(call.message, call.from_user.id, query, page)
         await call.answer()
     except Exception as e:
-        logging.error(f"Ошибка пагинации поиска: {e}")
+        logging.error("Ошибка пагинации поиска: %s", e)
         await call.answer("❌ Ошибка при пагинации поиска.")
 #endregion
 #region По категориям
@@ -358,10 +425,7 @@ async def expenses_history_categories(callback: CallbackQuery):
     pool = get_pool()
     
     try:
-        categories = await pool.fetch(
-            "SELECT DISTINCT category FROM expenses WHERE user_id = $1 ORDER BY category",
-            user_id
-        )
+        categories = await pool.fetch_named("expense_categories_used", user_id)
         
         if not categories:
             await callback.message.edit_text("❌ У вас ещё нет добавленных категорий.")
@@ -371,7 +435,7 @@ async def expenses_history_categories(callback: CallbackQuery):
         for cat in categories:
             builder.button(
                 text=cat['category'],
-                callback_data=f"category_page_{cat['category']}_1"
+                callback_data=f"category_page_{cat['category']}"
             )
         builder.button(text="🔙 Назад", callback_data="expenses_history")
         builder.adjust(2,1)
@@ -383,32 +447,30 @@ async def expenses_history_categories(callback: CallbackQuery):
         )
 
     except Exception as e:
-        logging.error(f"Ошибка при получении категорий: {e}")
+        logging.error("Ошибка при получении категорий: %s", e)
         await callback.message.answer("❌ Не удалось загрузить категории.")
 
-async def show_category_expenses_page(message: types.Message, user_id: int, category: str, page: int):
-    pool = get_pool()
-    
+async def show_category_expenses_page(message: types.Message, user_id: int, category: str | None,
+                                      direction: str | None = None, cursor_id: int | None = None, page: int = 1):
     try:
-        total_expenses = await pool.fetchval(
-            "SELECT COUNT(*) FROM expenses WHERE user_id = $1 AND category = $2",
-            user_id, category
-        ) or 0
+        # При листании категория берётся из граничной записи (category = None)
+        expenses, has_prev, has_next, page = await _fetch_keyset_page(
+            "expenses_category_page", [user_id, category], direction, cursor_id, page,
+            cursor_params=[user_id]
+        )
 
-        if total_expenses == 0:
-            await message.edit_text(f"📭 В категории <b>{category}</b> пока нет расходов.", parse_mode=ParseMode.HTML)
+        if not expenses:
+            if category is None:
+                await message.edit_text("📭 Записи не найдены, откройте категорию заново.")
+            else:
+                await message.edit_text(f"📭 В категории <b>{category}</b> пока нет расходов.", parse_mode=ParseMode.HTML)
             return
 
-        total_pages = max((total_expenses - 1) // EXPENSES_PER_PAGE + 1, 1)
-        offset = (page - 1) * EXPENSES_PER_PAGE
-
-        expenses = await pool.fetch(
-            "SELECT id, amount, date, time FROM expenses "
-            "WHERE user_id = $1 AND category = $2 "
-            "ORDER BY date DESC, (time IS NULL), time DESC, created_at DESC "
-            "LIMIT $3 OFFSET $4",
-            user_id, category, EXPENSES_PER_PAGE, offset
+        category = expenses[0]['category']
+        total_expenses = await _get_history_total(
+            user_id, ("category", category), "expenses_category_count", user_id, category
         )
+        total_pages = _total_pages(total_expenses, page)
 
         text = (
             f"📂 <b>Категория:</b> <i>{category}</i>\n"
@@ -426,16 +488,7 @@ async def show_category_expenses_page(message: types.Message, user_id: int, cate
             )
 
         builder = InlineKeyboardBuilder()
-        if page > 1:
-            builder.button(
-                text="⬅️ Назад",
-                callback_data=f"category_page_{category}_{page - 1}"
-            )
-        if page < total_pages:
-            builder.button(
-                text="Вперед ➡️",
-                callback_data=f"category_page_{category}_{page + 1}"
-            )
+        _add_nav_buttons(builder, "category_nav", expenses, page, has_prev, has_next)
         builder.button(text="📂 Все категории", callback_data="expenses_by_category")
         builder.button(text="🏠 В меню", callback_data="main_menu")
         builder.adjust(2)
@@ -445,23 +498,33 @@ async def show_category_expenses_page(message: types.Message, user_id: int, cate
         )
 
     except Exception as e:
-        logging.error(f"Ошибка при выводе расходов по категории: {e}")
+        logging.error("Ошибка при выводе расходов по категории: %s", e)
         await message.answer("❌ Не удалось получить данные по категории.")
 
 @expense_history_router.callback_query(F.data.startswith("category_page_"))
+async def show_category_first_page(callback: CallbackQuery):
+    try:
+        # category_page_{category}
+        category = callback.data[len("category_page_"):]
+        await show_category_expenses_page(callback.message, callback.from_user.id, category)
+        await callback.answer()
+
+    except Exception as e:
+        logging.error("Ошибка при выводе расходов по категории: %s", e)
+        await callback.answer("❌ Ошибка при загрузке страницы.")
+
+@expense_history_router.callback_query(F.data.startswith("category_nav_"))
 async def paginate_category_expenses(callback: CallbackQuery):
     try:
-        # category_page_{category}_{page}
-        parts = callback.data.split("_")
-        category = "_".join(parts[2:-1])  # Чтобы учесть _ в названии категории
-        page = int(parts[-1])
+        # category_nav_{n|p}_{id}_{page}
+        direction, cursor_id, page = _parse_nav(callback.data, "category_nav")
         user_id = callback.from_user.id
 
-        await show_category_expenses_page(callback.message, user_id, category, page)
+        await show_category_expenses_page(callback.message, user_id, None, direction, cursor_id, page)
         await callback.answer()
 
     except Exception as e:
-        logging.error(f"Ошибка при пагинации расходов по категории: {e}")
+        logging.error("Ошибка при пагинации расходов по категории: %s", e)
         await callback.answer("❌ Ошибка при загрузке страницы.")
 
 @expense_history_router.callback_query(F.data.startswith("category_history_"))
@@ -476,13 +539,7 @@ async def show_expenses_by_category(callback: CallbackQuery):
     pool = get_pool()
 
     try:
-        expenses = await pool.fetch(
-            "SELECT id, amount, date, time FROM expenses "
-            "WHERE user_id = $1 AND category = $2 "
-            "ORDER BY date DESC, (time IS NULL), time DESC, created_at DESC",
-            user_id,
-            category
-        )
+        expenses = await pool.fetch_named("expenses_category_all", user_id, category)
 
         if not expenses:
             await callback.message.edit_text(f"📭 Нет расходов в категории <b>{category}</b>.", parse_mode=ParseMode.HTML)
@@ -507,7 +564,7 @@ async def show_expenses_by_category(callback: CallbackQuery):
         await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
 
     except Exception as e:
-        logging.error(f"Ошибка при выводе расходов по категории: {e}")
+        logging.error("Ошибка при выводе расходов по категории: %s", e)
         await callback.message.answer("❌ Не удалось получить данные по категории.")
 #endregion
 #region
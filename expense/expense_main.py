@@ -1,4 +1,5 @@
 import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
 from aiogram import types, F, Router
 from aiogram.fsm.context import FSMContext
@@ -8,12 +9,17 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import CallbackQuery
 from datetime import datetime, date, time
-from expense.category import get_available_categories, PREDEFINED_CATEGORIES
+from expense.category import (
+    get_available_categories, get_category_lookup, mark_categories_used, PREDEFINED_CATEGORIES
+)
+from expense.changes import notify_expenses_changed
 from init import logging, ADMIN_ID
 from db.db_main import get_pool
 
 expense_router = Router()
 
+MAX_EXPENSE_AMOUNT = Decimal(10 ** 8)  # предел DECIMAL(10, 2) в таблице expenses
+
 # Предустановленные категории (доступны всем)
 
 def escape_markdown(text: str) -> str:
@@ -87,8 +93,10 @@ async def process_expense(message: types.Message, state: FSMContext):
     lines = message.text.strip().split('\n')
     success_count = 0
     failed_entries = []
+    # Сначала разбираем все строки, затем сохраняем их одной транзакцией
+    parsed_lines = []
 
-    available_categories = await get_available_categories(message.from_user.id)
+    category_lookup = await get_category_lookup(message.from_user.id)
 
     for line in lines:
         parts = line.strip().split()
@@ -99,18 +107,25 @@ async def process_expense(message: types.Message, state: FSMContext):
         category_input = parts[0].strip()
         amount_str = parts[1].replace(',', '.')
 
-        normalized_input = category_input.lower()
-        matched_category = next((cat for cat in available_categories if cat.lower() == normalized_input), None)
+        matched_category = category_lookup.get(category_input.lower())
 
         if not matched_category:
             failed_entries.append((line, "Категория не найдена"))
             continue
 
         try:
-            amount = float(amount_str)
-        except ValueError:
+            amount = Decimal(amount_str)
+        except InvalidOperation:
+            failed_entries.append((line, "Неверный формат суммы"))
+            continue
+        if not amount.is_finite():
+            # NaN и Infinity разбираются Decimal, но в столбец не запишутся
             failed_entries.append((line, "Неверный формат суммы"))
             continue
+        # Округляем так же, как столбец DECIMAL(10, 2), и только потом сверяем с пределом
+        # (огромные числа вроде 1e999 отсекаем заранее — quantize на них падает)
+        if abs(amount) < MAX_EXPENSE_AMOUNT:
+            amount = amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
         # Дата и время по умолчанию
         date_obj = datetime.utcnow().date()
@@ -134,20 +149,31 @@ async def process_expense(message: types.Message, state: FSMContext):
             failed_entries.append((line, "Неверный формат даты или времени"))
             continue
 
+        if abs(amount) >= MAX_EXPENSE_AMOUNT:
+            # Такая сумма не поместится в столбец и сорвала бы всю пачку
+            failed_entries.append((line, "Слишком большая сумма"))
+            continue
+
+        parsed_lines.append((line, matched_category, amount, date_obj, time_obj))
+
+    if parsed_lines:
         try:
-            if time_obj:
-                await pool.execute(
-                    "INSERT INTO expenses (user_id, category, amount, date, time) VALUES ($1, $2, $3, $4, $5)",
-                    message.from_user.id, matched_category, amount, date_obj, time_obj
-                )
-            else:
-                await pool.execute(
-                    "INSERT INTO expenses (user_id, category, amount, date) VALUES ($1, $2, $3, $4)",
-                    message.from_user.id, matched_category, amount, date_obj
-                )
-            success_count += 1
-        except Exception:
-            failed_entries.append((line, "Ошибка при сохранении"))
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute_named(
+                        "expenses_insert_bulk",
+                        message.from_user.id,
+                        [row[1] for row in parsed_lines],
+                        [row[2] for row in parsed_lines],
+                        [row[3] for row in parsed_lines],
+                        [row[4] for row in parsed_lines]
+                    )
+            success_count = len(parsed_lines)
+            mark_categories_used(message.from_user.id, {row[1] for row in parsed_lines})
+            notify_expenses_changed(message.from_user.id)
+        except Exception as e:
+            logging.error("❌ Ошибка при сохранении расходов пользователя %s: %s", message.from_user.id, e)
+            failed_entries.extend((row[0], "Ошибка при сохранении") for row in parsed_lines)
 
     # Ответ пользователю
     response = f"✅ Добавлено расходов: {success_count}\n"
@@ -174,26 +200,10 @@ async def is_duplicate_expense(
     time_obj: time | None = None
 ) -> bool:
     pool = get_pool()
-    async with pool.acquire() as conn:
-        if time_obj:
-            result = await conn.fetchval(
-                """
-                SELECT 1 FROM expenses
-                WHERE user_id = $1 AND category = $2 AND amount = $3 AND date = $4 AND time = $5
-                LIMIT 1
-                """,
-                user_id, category, amount, date_obj, time_obj
-            )
-        else:
-            result = await conn.fetchval(
-                """
-                SELECT 1 FROM expenses
-                WHERE user_id = $1 AND category = $2 AND amount = $3 AND date = $4 AND time IS NULL
-                LIMIT 1
-                """,
-                user_id, category, amount, date_obj
-            )
-
-        return result is not None
+    result = await pool.fetchval_named(
+        "expense_duplicate_exists",
+        user_id, category, amount, date_obj, time_obj
+    )
+    return result is not None
 #endregion
 
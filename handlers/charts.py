@@ -0,0 +1,192 @@
+import asyncio
+import io
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from init import (
+    logging, CHART_WORKERS, CHART_QUEUE_LIMIT, CHART_TIMEOUT,
+    CHART_CACHE_MAX_BYTES, CHART_CACHE_MAX_ENTRIES
+)
+
+# Графики рисуются в пуле процессов: matplotlib не блокирует цикл событий
+# и не делит глобальное состояние pyplot между обработчиками.
+
+_executor: ProcessPoolExecutor | None = None
+_pending = 0  # графиков в работе и в очереди
+
+class ChartQueueFullError(Exception):
+    """Очередь отрисовки графиков переполнена"""
+
+#region Код рабочих процессов
+def _render_pie_chart(title: str, categories: list[str], amounts: list[float]) -> bytes:
+    """Рисует круговую диаграмму и возвращает PNG"""
+    # Возвраты и нулевые категории на круговой диаграмме не изобразить
+    slices = [(cat, amount) for cat, amount in zip(categories, amounts) if amount > 0]
+    if not slices:
+        raise ValueError("Нет положительных сумм для круговой диаграммы")
+    categories = [cat for cat, _ in slices]
+    amounts = [amount for _, amount in slices]
+    total_sum = sum(amounts)
+    labels = [
+        f"{cat} — {amount:.2f} ₽ ({(amount/total_sum)*100:.1f}%)"
+        for cat, amount in zip(categories, amounts)
+    ]
+
+    with matplotlib.rc_context({'font.size': 12, 'font.weight': 'bold'}):
+        fig = Figure(figsize=(8, 8))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.set_facecolor('#f0f0f0')
+
+        wedges, texts, autotexts = ax.pie(
+            amounts,
+            labels=labels,
+            startangle=140,
+            autopct=lambda pct: f"{pct:.1f}%" if pct > 3 else "",
+            colors=matplotlib.colormaps["Paired"].colors,
+            wedgeprops={"edgecolor": "white"}
+        )
+
+        for text in texts + autotexts:
+            text.set_fontsize(10)
+            text.set_fontweight('bold')
+
+        ax.set_title(title, fontsize=14, fontweight='bold')
+        fig.tight_layout()
+
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png")
+        return buf.getvalue()
+
+def _warm_up_worker():
+    """Прогрев процесса: загрузка шрифтов и кэшей matplotlib до первого запроса"""
+    try:
+        _render_pie_chart("warm-up", ["a", "b"], [1.0, 2.0])
+    except Exception as e:
+        logging.warning("⚠️ Не удалось прогреть процесс отрисовки графиков: %s", e)
+
+def _noop():
+    return None
+#endregion
+
+#region Управление пулом
+def start_chart_workers():
+    """Запускает и прогревает рабочие процессы отрисовки"""
+    global _executor
+    if _executor is not None:
+        return
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # Предзагружаем только этот модуль, а не main.py с ботом и диспетчером
+        ctx.set_forkserver_preload([__name__])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+
+    _executor = ProcessPoolExecutor(
+        max_workers=CHART_WORKERS,
+        mp_context=ctx,
+        initializer=_warm_up_worker
+    )
+    # Процессы создаются по требованию — запускаем их все сразу
+    for _ in range(CHART_WORKERS):
+        _executor.submit(_noop)
+    logging.info("📈 Запущено процессов отрисовки графиков: %s", CHART_WORKERS)
+
+def shutdown_chart_workers():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def _release_slot():
+    global _pending
+    _pending -= 1
+
+async def render_pie_chart(title: str, categories: list[str], amounts: list[float]) -> bytes:
+    """Рисует круговую диаграмму в пуле процессов.
+
+    Бросает ChartQueueFullError, если очередь заполнена, и asyncio.TimeoutError,
+    если отрисовка не уложилась в CHART_TIMEOUT.
+    """
+    global _pending
+    if _executor is None:
+        start_chart_workers()
+    if _pending >= CHART_QUEUE_LIMIT:
+        raise ChartQueueFullError()
+
+    future = _executor.submit(_render_pie_chart, title, categories, amounts)
+    _pending += 1
+    # После таймаута процесс дорисовывает график — место в очереди освобождаем
+    # только когда работа действительно завершилась
+    loop = asyncio.get_running_loop()
+    future.add_done_callback(lambda _: loop.is_closed() or loop.call_soon_threadsafe(_release_slot))
+    return await asyncio.wait_for(asyncio.wrap_future(future), timeout=CHART_TIMEOUT)
+#endregion
+
+#region Кэш готовых графиков
+# Ключ: (user_id, период, начало периода, конец периода, версия данных пользователя).
+# Значение: {"png": bytes | None, "file_id": str | None}. После первой отправки
+# храним только file_id Telegram — повторный показ не требует ни отрисовки, ни загрузки.
+_chart_cache: OrderedDict[tuple, dict] = OrderedDict()
+_chart_cache_bytes = 0
+_user_chart_keys: dict[int, set] = {}
+
+def _drop_chart(key: tuple):
+    global _chart_cache_bytes
+    entry = _chart_cache.pop(key, None)
+    if entry is None:
+        return
+    if entry["png"] is not None:
+        _chart_cache_bytes -= len(entry["png"])
+    keys = _user_chart_keys.get(key[0])
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del _user_chart_keys[key[0]]
+
+def _evict_charts():
+    while _chart_cache and (
+        _chart_cache_bytes > CHART_CACHE_MAX_BYTES or len(_chart_cache) > CHART_CACHE_MAX_ENTRIES
+    ):
+        _drop_chart(next(iter(_chart_cache)))
+
+def get_cached_chart(key: tuple) -> dict | None:
+    entry = _chart_cache.get(key)
+    if entry is not None:
+        _chart_cache.move_to_end(key)
+    return entry
+
+def store_chart_png(key: tuple, png: bytes):
+    global _chart_cache_bytes
+    _drop_chart(key)
+    _chart_cache[key] = {"png": png, "file_id": None}
+    _chart_cache_bytes += len(png)
+    _user_chart_keys.setdefault(key[0], set()).add(key)
+    _evict_charts()
+
+def store_chart_file_id(key: tuple, file_id: str):
+    """Запоминает file_id загруженного графика и освобождает PNG"""
+    global _chart_cache_bytes
+    entry = _chart_cache.get(key)
+    if entry is None:
+        entry = _chart_cache[key] = {"png": None, "file_id": None}
+        _user_chart_keys.setdefault(key[0], set()).add(key)
+    if entry["png"] is not None:
+        _chart_cache_bytes -= len(entry["png"])
+        entry["png"] = None
+    entry["file_id"] = file_id
+    _chart_cache.move_to_end(key)
+    _evict_charts()
+
+def invalidate_user_charts(user_id: int):
+    """Удаляет все графики пользователя (данные изменились)"""
+    for key in list(_user_chart_keys.get(user_id, ())):
+        _drop_chart(key)
+#endregion
@@ -20,7 +20,7 @@ async def test_date(message: types.Message):
     pool = get_pool()
     try:
         await message.answer("Переключаюсь на inline-кнопки", reply_markup=ReplyKeyboardRemove())
-        current = await pool.fetchval("SELECT CURRENT_DATE")
+        current = await pool.fetchval_named("db_current_date")
         week_ago = current - timedelta(days=7)
         month_start = current.replace(day=1)
         await message.answer(
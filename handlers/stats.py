@@ -1,8 +1,8 @@
 
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
-import io
-from aiogram.types import InputMediaPhoto, InputFile, CallbackQuery
+import asyncio
+import time
+from collections import OrderedDict
+from aiogram.types import InputMediaPhoto, BufferedInputFile, CallbackQuery
 
 from aiogram.exceptions import TelegramAPIError
 from aiogram import types, F, Router
@@ -14,10 +14,44 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
 from datetime import  date, timedelta, datetime
 
 from init import logging, ADMIN_ID
-from db.db_main import get_pool
+from db.db_main import get_pool, get_pool_stats
+from handlers.charts import (
+    render_pie_chart, ChartQueueFullError,
+    get_cached_chart, store_chart_png, store_chart_file_id, invalidate_user_charts
+)
+from expense.changes import get_data_version, on_expenses_changed
+from db.clock import db_today
 
 stats_router = Router()
 
+STATS_CACHE_TTL = 300  # секунд хранения результатов статистики
+STATS_CACHE_MAX_ENTRIES = 20_000
+REBUILD_TIMEOUT = 3600  # секунд на пересборку агрегатов по всей таблице (админ-команды)
+
+# (user_id, период, начало, конец) -> (время истечения, итог, строки); порядок = LRU.
+# Один результат обслуживает все виды статистики: обычную, по категориям и график.
+_stats_cache: OrderedDict[tuple, tuple] = OrderedDict()
+_user_stats_keys: dict[int, set] = {}
+stats_cache_hits = 0
+stats_cache_misses = 0
+
+# Графики пользователя устаревают при любом изменении его расходов
+on_expenses_changed(invalidate_user_charts)
+
+def _drop_stats_entry(key: tuple):
+    _stats_cache.pop(key, None)
+    keys = _user_stats_keys.get(key[0])
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del _user_stats_keys[key[0]]
+
+@on_expenses_changed
+def invalidate_user_stats(user_id: int):
+    """Сбрасывает кэш статистики пользователя после изменения расходов"""
+    for key in list(_user_stats_keys.get(user_id, ())):
+        _drop_stats_entry(key)
+
 class StatsState(StatesGroup):
     choosing_period = State()
     choosing_type = State()
@@ -82,17 +116,19 @@ async def process_custom_period(message: types.Message, state: FSMContext):
 
 
 def get_period_filter(period_key: str, current_date: date, user_id: int, custom_period=None):
+    # params = [user_id, начало, конец] для запросов статистики из db/queries.py,
+    # которые читают дневные суммы expense_daily, а не отдельные расходы
     if period_key == "period_today":
         return {
-            "condition": "date = $2::date",
-            "params": [user_id, current_date],
+            "period_key": period_key,
+            "params": [user_id, current_date, current_date],
             "title_suffix": "сегодня",
             "period_info": current_date.strftime('%d.%m.%Y')
         }
     elif period_key == "period_week":
         week_start = current_date - timedelta(days=6)
         return {
-            "condition": "date BETWEEN $2 AND $3",
+            "period_key": period_key,
             "params": [user_id, week_start, current_date],
             "title_suffix": "неделя",
             "period_info": f"{week_start.strftime('%d.%m.%Y')} - {current_date.strftime('%d.%m.%Y')}"
@@ -100,15 +136,16 @@ def get_period_filter(period_key: str, current_date: date, user_id: int, custom_
     elif period_key == "period_month":
         month_start = current_date.replace(day=1)
         return {
-            "condition": "date BETWEEN $2 AND $3",
+            "period_key": period_key,
             "params": [user_id, month_start, current_date],
             "title_suffix": "месяц",
             "period_info": f"{month_start.strftime('%d.%m.%Y')} - {current_date.strftime('%d.%m.%Y')}"
         }
     elif period_key == "period_all":
+        # date.min/date.max asyncpg передаёт как -infinity/infinity
         return {
-            "condition": "TRUE",
-            "params": [user_id],
+            "period_key": period_key,
+            "params": [user_id, date.min, date.max],
             "title_suffix": "всё время",
             "period_info": "за весь период"
         }
@@ -117,7 +154,7 @@ def get_period_filter(period_key: str, current_date: date, user_id: int, custom_
             raise ValueError("Для кастомного периода нужно передать даты")
         start_date, end_date = custom_period
         return {
-            "condition": "date BETWEEN $2 AND $3",
+            "period_key": period_key,
             "params": [user_id, start_date, end_date],
             "title_suffix": f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}",
             "period_info": f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
@@ -136,6 +173,40 @@ async def get_period_info_for_state(state: FSMContext, current_date: date, user_
     return get_period_filter(period_key, current_date, user_id, custom_period=custom_period)
 
 
+async def fetch_period_stats(period_key: str, params: list):
+    """Возвращает (общая сумма, строки по категориям) из кэша или одним запросом"""
+    global stats_cache_hits, stats_cache_misses
+    user_id, start_date, end_date = params
+    key = (user_id, period_key, start_date, end_date)
+
+    cached = _stats_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        stats_cache_hits += 1
+        _stats_cache.move_to_end(key)
+        return cached[1], cached[2]
+    stats_cache_misses += 1
+
+    # Если данные изменились, пока шёл запрос, результат мог устареть — не кэшируем его
+    version = get_data_version(user_id)
+    rows = await get_pool().fetch_named("stats_by_category", *params)
+    total = 0
+    categories = []
+    for row in rows:
+        if row["is_total"]:
+            total = row["total"] or 0
+        else:
+            categories.append(row)
+
+    if get_data_version(user_id) != version:
+        return total, categories
+
+    _stats_cache[key] = (time.monotonic() + STATS_CACHE_TTL, total, categories)
+    _stats_cache.move_to_end(key)
+    _user_stats_keys.setdefault(user_id, set()).add(key)
+    while len(_stats_cache) > STATS_CACHE_MAX_ENTRIES:
+        _drop_stats_entry(next(iter(_stats_cache)))
+    return total, categories
+
 def back_button(callback: str = "show_stats_menu"):
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text="🔙 Назад", callback_data=callback))
@@ -176,8 +247,7 @@ async def show_stats_by_categories(call: CallbackQuery, state: FSMContext):
         logging.error("❌ БД не инициализирована")
         return
 
-    db_now = await pool.fetchval("SELECT NOW()")
-    current_date = db_now.date()
+    current_date = db_today()
 
     try:
         period_info = await get_period_info_for_state(state, current_date, call.from_user.id)
@@ -186,19 +256,11 @@ async def show_stats_by_categories(call: CallbackQuery, state: FSMContext):
         return
 
 
-    date_condition = period_info["condition"]
     params = period_info["params"]
     title = f"📊 Расходы по категориям ({period_info['title_suffix']})"
 
     try:
-        query = f"""
-            SELECT category, COUNT(*) as count, SUM(amount) as total
-            FROM expenses
-            WHERE user_id = $1 AND {date_condition}
-            GROUP BY category
-            ORDER BY total DESC
-        """
-        records = await pool.fetch(query, *params)
+        _, records = await fetch_period_stats(period_info["period_key"], params)
 
         if not records:
             text = f"{title}\n\nНет данных за выбранный период."
@@ -211,10 +273,22 @@ async def show_stats_by_categories(call: CallbackQuery, state: FSMContext):
         await call.answer()
 
     except Exception as e:
-        logging.error(f"Ошибка при получении статистики по категориям: {e}", exc_info=True)
+        logging.error("Ошибка при получении статистики по категориям: %s", e, exc_info=True)
         await call.message.answer("❌ Не удалось получить статистику.")
         await call.answer()
 
+async def _send_chart(call: CallbackQuery, chart_key: tuple, title: str, png: bytes):
+    media = InputMediaPhoto(
+        media=BufferedInputFile(png, filename="stats_graph.png"),
+        caption=title,
+        parse_mode=ParseMode.HTML
+    )
+
+    sent = await call.message.edit_media(media=media, reply_markup=back_button().as_markup())
+    if isinstance(sent, types.Message) and sent.photo:
+        store_chart_file_id(chart_key, sent.photo[-1].file_id)
+    await call.answer()
+
 @stats_router.callback_query(F.data == "stat_type_graph")
 async def show_stats_graph_for_period(call: CallbackQuery, state: FSMContext):
     pool = get_pool()
@@ -230,8 +304,7 @@ async def show_stats_graph_for_period(call: CallbackQuery, state: FSMContext):
         await call.message.answer("⚠️ Не удалось определить период.")
         return
 
-    db_now = await pool.fetchval("SELECT NOW()")
-    current_date = db_now.date()
+    current_date = db_today()
 
     try:
         period_info = get_period_filter(period_key, current_date, call.from_user.id, custom_period=custom_period)
@@ -239,69 +312,54 @@ async def show_stats_graph_for_period(call: CallbackQuery, state: FSMContext):
         await call.message.answer(str(e))
         return
 
-    date_condition = period_info["condition"]
     params = period_info["params"]
     title = f"📈 Диаграмма ({period_info['title_suffix']})"
+    user_id, start_date, end_date = params
+    # Заголовок с периодом нарисован на картинке, поэтому период входит в ключ:
+    # у «сегодня» и «месяца» 1-го числа границы совпадают
+    chart_key = (user_id, period_key, start_date, end_date, get_data_version(user_id))
 
     try:
-        stats = await pool.fetch(
-            f"""
-            SELECT category, SUM(amount) as total
-            FROM expenses
-            WHERE user_id = $1 AND {date_condition}
-            GROUP BY category
-            ORDER BY total DESC
-            """,
-            *params
-        )
+        cached = get_cached_chart(chart_key)
+        if cached and cached["file_id"]:
+            # Этот график уже загружен в Telegram — отправляем по file_id
+            media = InputMediaPhoto(media=cached["file_id"], caption=title, parse_mode=ParseMode.HTML)
+            await call.message.edit_media(media=media, reply_markup=back_button().as_markup())
+            await call.answer()
+            return
 
-        if not stats:
-            await call.answer("ℹ️ Нет данных для построения графика.", show_alert=True)
+        if cached and cached["png"]:
+            await _send_chart(call, chart_key, title, cached["png"])
             return
 
-        categories = [row["category"] for row in stats]
-        amounts = [float(row["total"]) for row in stats]
-        total_sum = sum(amounts)
-
-        labels = [
-            f"{cat} — {amount:.2f} ₽ ({(amount/total_sum)*100:.1f}%)"
-            for cat, amount in zip(categories, amounts)
-        ]
-
-        rcParams.update({'font.size': 12, 'font.weight': 'bold'})
-        plt.figure(figsize=(8, 8))
-        plt.gca().set_facecolor('#f0f0f0')
-
-        wedges, texts, autotexts = plt.pie(
-            amounts,
-            labels=labels,
-            startangle=140,
-            autopct=lambda pct: f"{pct:.1f}%" if pct > 3 else "",
-            colors=plt.cm.Paired.colors,
-            wedgeprops={"edgecolor": "white"}
-        )
+        _, stats = await fetch_period_stats(period_key, params)
 
-        for text in texts + autotexts:
-            text.set_fontsize(10)
-            text.set_fontweight('bold')
+        # Категории с нулевой или отрицательной суммой на диаграмме не изобразить
+        rows = [row for row in stats if row["total"] > 0]
+        if not rows:
+            await call.answer("ℹ️ Нет данных для построения графика.", show_alert=True)
+            return
 
-        plt.title(title, fontsize=14, fontweight='bold')
-        plt.tight_layout()
+        categories = [row["category"] for row in rows]
+        amounts = [float(row["total"]) for row in rows]
 
-        buf = io.BytesIO()
-        plt.savefig(buf, format="png")
-        buf.seek(0)
-        plt.close()
+        # Отрисовка идёт в отдельном процессе, цикл событий не блокируется
+        png = await render_pie_chart(title, categories, amounts)
+        store_chart_png(chart_key, png)
 
-        media = InputMediaPhoto(media=InputFile(buf, filename="stats_graph.png"), caption=title, parse_mode=ParseMode.HTML)
+        await _send_chart(call, chart_key, title, png)
 
-        await call.message.edit_media(media=media, reply_markup=back_button().as_markup())
+    except ChartQueueFullError:
+        logging.warning("⚠️ Очередь отрисовки графиков переполнена")
+        await call.answer("⏳ Сейчас строится много графиков, попробуйте через минуту.", show_alert=True)
 
-        buf.close()
+    except asyncio.TimeoutError:
+        logging.error("❌ Превышено время построения графика")
+        await call.message.answer("❌ Не удалось построить график.")
         await call.answer()
 
     except Exception as e:
-        logging.error(f"Ошибка при построении графика: {e}", exc_info=True)
+        logging.error("Ошибка при построении графика: %s", e, exc_info=True)
         await call.message.answer("❌ Не удалось построить график.")
         await call.answer()
 
@@ -322,26 +380,17 @@ async def handle_stats_period(call: CallbackQuery, state: FSMContext):
 async def user_stats(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         logging.warning(
-            f"⛔ Попытка доступа к /user_stats от пользователя ID: {message.from_user.id}, username: @{message.from_user.username}"
+            "⛔ Попытка доступа к /user_stats от пользователя ID: %s, username: @%s", message.from_user.id, message.from_user.username
         )
         return await message.answer("❌ Доступ запрещен")
 
     logging.info(
-        f"✅ Админ {message.from_user.id} запросил статистику пользователей (/user_stats)"
+        "✅ Админ %s запросил статистику пользователей (/user_stats)", message.from_user.id
     )
 
     db_pool = get_pool()
     try:
-        stats = await db_pool.fetch(
-            """
-            SELECT u.user_id, u.username, COUNT(e.id) AS expenses_count,
-                   SUM(e.amount) AS total_amount, MAX(u.last_active) AS last_active
-            FROM users u
-            LEFT JOIN expenses e ON u.user_id = e.user_id
-            GROUP BY u.user_id
-            ORDER BY last_active DESC
-            """
-        )
+        stats = await db_pool.fetch_named("admin_user_stats")
 
         if not stats:
             return await message.answer("ℹ️ Пока нет данных о пользователях.")
@@ -361,9 +410,106 @@ async def user_stats(message: types.Message):
 
         await message.answer(text, parse_mode="HTML")
     except Exception as e:
-        logging.error(f"❌ Ошибка при получении статистики пользователей: {e}", exc_info=True)
+        logging.error("❌ Ошибка при получении статистики пользователей: %s", e, exc_info=True)
         await message.answer("❌ Не удалось загрузить статистику пользователей.")
 
+@stats_router.message(Command("db_stats"))
+async def db_pool_stats(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Доступ запрещен")
+
+    stats = get_pool_stats()
+    if stats is None:
+        return await message.answer("⚠️ Пул соединений с БД не инициализирован.")
+
+    text = (
+        "🔌 <b>Пул соединений БД:</b>\n\n"
+        f"├ Размер: {stats['size']} (мин. {stats['min_size']}, макс. {stats['max_size']})\n"
+        f"├ Занято: {stats['in_use']}, свободно: {stats['idle']}\n"
+        f"├ Выдано соединений: {stats['acquire_count']}\n"
+        f"├ Ожидание: ср. {stats['acquire_wait_avg_ms']:.1f} мс, макс. {stats['acquire_wait_max_ms']:.1f} мс\n"
+        f"╰ Таймауты ожидания: {stats['acquire_timeouts']}"
+    )
+    await message.answer(text, parse_mode="HTML")
+
+@stats_router.message(Command("reconcile_totals"))
+async def reconcile_user_totals(message: types.Message):
+    """Пересобирает user_totals из expenses и сообщает о найденных расхождениях"""
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Доступ запрещен")
+
+    logging.info("🧮 Админ %s запустил сверку user_totals", message.from_user.id)
+
+    db_pool = get_pool()
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                # statement_timeout пула оборвал бы пересборку на большой таблице
+                await conn.execute("SET LOCAL statement_timeout = 0")
+                # Блокируем запись итогов, чтобы пересборка не разошлась с параллельными изменениями
+                await conn.execute_named("user_totals_lock", timeout=REBUILD_TIMEOUT)
+                drift = await conn.fetch_named("user_totals_drift", timeout=REBUILD_TIMEOUT)
+                await conn.execute_named("user_totals_rebuild", timeout=REBUILD_TIMEOUT)
+
+        if not drift:
+            return await message.answer("✅ Итоги пользователей совпадают с данными расходов.")
+
+        text = f"⚠️ <b>Найдено расхождений: {len(drift)}</b> (итоги пересобраны)\n\n"
+        for row in drift[:30]:
+            text += (
+                f"ID {row['user_id']}: записей {row['stored_count'] or 0} → {row['actual_count'] or 0}, "
+                f"сумма {row['stored_amount'] or 0:.2f} → {row['actual_amount'] or 0:.2f} ₽\n"
+            )
+        if len(drift) > 30:
+            text += f"… и ещё {len(drift) - 30}\n"
+        logging.warning("⚠️ Сверка user_totals: исправлено расхождений: %s", len(drift))
+        await message.answer(text, parse_mode="HTML")
+    except Exception as e:
+        logging.error("❌ Ошибка при сверке user_totals: %s", e, exc_info=True)
+        await message.answer("❌ Не удалось выполнить сверку итогов.")
+
+@stats_router.message(Command("rebuild_daily_stats"))
+async def rebuild_daily_stats(message: types.Message):
+    """Пересобирает expense_daily из expenses: /rebuild_daily_stats [user_id]"""
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Доступ запрещен")
+
+    args = message.text.split()
+    target_user = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+    logging.info("🧮 Админ %s запустил пересборку expense_daily (user: %s)", message.from_user.id, target_user or 'все')
+
+    db_pool = get_pool()
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                # statement_timeout пула оборвал бы пересборку на большой таблице
+                await conn.execute("SET LOCAL statement_timeout = 0")
+                await conn.execute_named("expense_daily_lock", timeout=REBUILD_TIMEOUT)
+                await conn.execute_named("expense_daily_clear", target_user, timeout=REBUILD_TIMEOUT)
+                result = await conn.execute_named("expense_daily_backfill", target_user, timeout=REBUILD_TIMEOUT)
+
+        rows = result.split()[-1]
+        await message.answer(f"✅ Дневные суммы пересобраны, строк: {rows}")
+    except Exception as e:
+        logging.error("❌ Ошибка при пересборке expense_daily: %s", e, exc_info=True)
+        await message.answer("❌ Не удалось пересобрать дневные суммы.")
+
+@stats_router.message(Command("cache_stats"))
+async def cache_stats(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Доступ запрещен")
+
+    lookups = stats_cache_hits + stats_cache_misses
+    hit_rate = stats_cache_hits / lookups * 100 if lookups else 0.0
+    text = (
+        "🗃 <b>Кэш статистики:</b>\n\n"
+        f"├ Записей: {len(_stats_cache)} из {STATS_CACHE_MAX_ENTRIES}\n"
+        f"├ Попаданий: {stats_cache_hits}\n"
+        f"├ Промахов: {stats_cache_misses}\n"
+        f"╰ Доля попаданий: {hit_rate:.1f}%"
+    )
+    await message.answer(text, parse_mode="HTML")
+
 @stats_router.callback_query(F.data == "stat_type_regular")
 async def show_regular_stats(call: CallbackQuery, state: FSMContext):
     pool = get_pool()
@@ -378,28 +524,16 @@ async def show_regular_stats(call: CallbackQuery, state: FSMContext):
         await call.message.answer("⚠️ Не удалось определить период.")
         return
 
-    db_now = await pool.fetchval("SELECT NOW()")
-    current_date = db_now.date()
+    current_date = db_today()
 
     period_info = await get_period_info_for_state(state, current_date, call.from_user.id)
 
-    date_condition = period_info["condition"]
     params = period_info["params"]
     title = f"📊 Статистика за {period_info['title_suffix']}"
     period_text = period_info["period_info"]
 
     try:
-        total = await pool.fetchval(
-            f"SELECT COALESCE(SUM(amount), 0) FROM expenses "
-            f"WHERE user_id = $1 AND {date_condition}",
-            *params
-        )
-        stats = await pool.fetch(
-            f"SELECT category, COALESCE(SUM(amount), 0) as sum FROM expenses "
-            f"WHERE user_id = $1 AND {date_condition} "
-            f"GROUP BY category ORDER BY sum DESC",
-            *params
-        )
+        total, stats = await fetch_period_stats(period_key, params)
 
         response = (
             f"{title}\n"
@@ -408,7 +542,7 @@ async def show_regular_stats(call: CallbackQuery, state: FSMContext):
         )
         if stats:
             for i, row in enumerate(stats, 1):
-                response += f"{i}. {row['category']}: {row['sum']:.2f} ₽\n"
+                response += f"{i}. {row['category']}: {row['total']:.2f} ₽\n"
         else:
             response += "Нет данных за выбранный период\n"
 
@@ -416,6 +550,6 @@ async def show_regular_stats(call: CallbackQuery, state: FSMContext):
         await call.answer()
 
     except Exception as e:
-        logging.error(f"Ошибка при получении статистики: {e}", exc_info=True)
+        logging.error("Ошибка при получении статистики: %s", e, exc_info=True)
         await call.message.answer("❌ Не удалось загрузить статистику.")
         await call.answer()
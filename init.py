@@ -12,7 +12,40 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 BOT_TOKEN=os.getenv("BOT_TOKEN")
+# Способ получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "0.0.0.0")  # адрес, на котором слушает сервер
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_BASE_URL = getenv("WEBHOOK_BASE_URL", "")  # внешний https-адрес; пусто — не регистрировать вебхук
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET", "")
+# Число процессов-обработчиков; больше 1 — апдейты раздаются по user_id
+BOT_WORKERS = int(getenv("BOT_WORKERS", "1"))
 DB_URL=os.getenv("DB_URL")
+# Хранилище состояний FSM: "postgres" (по умолчанию) или "memory"
+FSM_STORAGE = getenv("FSM_STORAGE", "postgres")
+# Лимиты исходящих запросов к Telegram (сообщений в секунду)
+OUTBOUND_GLOBAL_RATE = float(getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_RATE = float(getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))
+# Настройки пула соединений с БД
+DB_POOL_MIN_SIZE = int(getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(getenv("DB_POOL_MAX_SIZE", "20"))
+DB_STATEMENT_CACHE_SIZE = int(getenv("DB_STATEMENT_CACHE_SIZE", "200"))
+DB_MAX_INACTIVE_LIFETIME = float(getenv("DB_MAX_INACTIVE_LIFETIME", "300"))  # сек
+DB_COMMAND_TIMEOUT = float(getenv("DB_COMMAND_TIMEOUT", "10"))  # сек
+DB_ACQUIRE_TIMEOUT = float(getenv("DB_ACQUIRE_TIMEOUT", "5"))  # сек
+DB_STATEMENT_TIMEOUT_MS = int(getenv("DB_STATEMENT_TIMEOUT_MS", "10000"))
+DB_APPLICATION_NAME = getenv("DB_APPLICATION_NAME", "ezhefinka")
+# Строить индексы миграций через CREATE INDEX CONCURRENTLY (для живой БД)
+DB_MIGRATIONS_CONCURRENTLY = getenv("DB_MIGRATIONS_CONCURRENTLY", "0") == "1"
+# Отрисовка графиков в отдельных процессах
+CHART_WORKERS = int(getenv("CHART_WORKERS", "2"))
+CHART_QUEUE_LIMIT = int(getenv("CHART_QUEUE_LIMIT", "16"))  # графиков в работе и в очереди
+CHART_TIMEOUT = float(getenv("CHART_TIMEOUT", "15"))  # сек
+CHART_CACHE_MAX_BYTES = int(getenv("CHART_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CHART_CACHE_MAX_ENTRIES = int(getenv("CHART_CACHE_MAX_ENTRIES", "5000"))
 ADMIN_ID = int(getenv("ADMIN_ID"))
 db_user=os.getenv("DB_USER"),
 db_password=os.getenv("DB_PASSWORD"),
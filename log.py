@@ -4,10 +4,20 @@
 import os
 import html
 import logging
+import logging.handlers
 import asyncio
+import atexit
+import queue
 from datetime import datetime, timedelta
 from tempfile import NamedTemporaryFile
 import json
+import re
+import gzip
+import time
+import threading
+import multiprocessing
+from collections import deque
+from itertools import islice
 # 📌 Сторонние библиотеки
 import aiogram.exceptions
 from aiogram import types, Router, F
@@ -30,25 +40,117 @@ logs_router = Router()
 
 CONFIG_FILE = "config.json"
 LOG_PATH = "bot.log"
-CLEAN_INTERVAL_DAYS = 7
+CLEAN_INTERVAL_DAYS = 7  # плановая ротация лога (раньше — очистка)
+LOG_MAX_BYTES = 20 * 1024 * 1024  # ротация при достижении размера
+LOG_RETENTION_DAYS = 90  # сколько хранить сжатые сегменты
+LOG_MAX_SEGMENTS = 100
+LOG_MAINTENANCE_INTERVAL = 60  # секунд между проверками ротации и хранения
+LOG_INDEX_SUFFIX = ".idx"  # файл-спутник с индексом смещений
+LOG_INDEX_LINES_TAG = "lines"  # строка индекса сжатого сегмента с числом строк в нём
+LOG_INDEX_BUCKET = 60  # секунд на одну запись индекса
+TAIL_BLOCK_SIZE = 64 * 1024  # байт, читаемых за шаг при поиске с конца файла
 # Храним глобальное время последней очистки
 
+CONFIG_SAVE_DELAY = 0.5  # секунд: изменения за это время сохраняются одной записью
+
+class ConfigStore:
+    """Конфигурация в памяти с отложенным атомарным сохранением в JSON.
+
+    Файл читается один раз, дальше чтение идёт из памяти. Изменения пишутся
+    в фоновом потоке не чаще раза в CONFIG_SAVE_DELAY: во временный файл рядом
+    с конфигом, затем os.replace — при падении на диске остаётся либо старая,
+    либо новая версия целиком.
+    """
+
+    DEFAULTS = {"ai_assistant_enabled": True, "send_media_alerts": False}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # записи на диск идут строго по очереди
+        self._data: dict | None = None
+        self._version = 0  # номер последнего изменения
+        self._saved_version = 0
+        self._timer: threading.Timer | None = None
+
+    def _load(self) -> dict:
+        if self._data is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as file:
+                    self._data = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._data = dict(self.DEFAULTS)
+        return self._data
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self._load().get(key, default)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._load())
+
+    def _schedule_save(self):
+        # Вызывается под self._lock
+        self._version += 1
+        if self._timer is None:
+            self._timer = threading.Timer(CONFIG_SAVE_DELAY, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def update(self, **values):
+        """Меняет значения в памяти и планирует сохранение на диск"""
+        with self._lock:
+            self._load().update(values)
+            self._schedule_save()
+
+    def replace(self, data: dict):
+        with self._lock:
+            self._data = dict(data)
+            self._schedule_save()
+
+    def flush(self):
+        """Сохраняет текущее состояние, если оно ещё не записано (блокирующий вызов)"""
+        with self._write_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if self._version == self._saved_version:
+                return
+            data, version = dict(self._data), self._version
+
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        try:
+            with NamedTemporaryFile(
+                "w", encoding="utf-8", dir=dirname, prefix=".config-", suffix=".tmp", delete=False
+            ) as file:
+                json.dump(data, file, indent=4, ensure_ascii=False)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(file.name, self.path)
+        except OSError as e:
+            logging.error("❌ Ошибка при сохранении конфигурации: %s", e)
+            return
+
+        with self._lock:
+            self._saved_version = max(self._saved_version, version)
+
+config_store = ConfigStore(CONFIG_FILE)
+# Несохранённые изменения дописываем при выходе
+atexit.register(config_store.flush)
+
 def load_config():
-    """Загружает конфигурацию из JSON-файла."""
-    try:
-        with open(CONFIG_FILE, "r", encoding="utf-8") as file:
-            return json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"ai_assistant_enabled": True, "send_media_alerts": False} 
+    """Возвращает копию конфигурации (из памяти, без чтения файла)."""
+    return config_store.snapshot()
 
 def save_config(data):
-    """Сохраняет конфигурацию в JSON-файл."""
-    with open(CONFIG_FILE, "w", encoding="utf-8") as file:
-        json.dump(data, file, indent=4, ensure_ascii=False)
+    """Заменяет конфигурацию; в JSON-файл она сохранится в фоне."""
+    config_store.replace(data)
 
 def get_last_cleanup_time() -> datetime:
-    config = load_config()
-    time_str = config.get("last_cleanup_time")
+    time_str = config_store.get("last_cleanup_time")
     if time_str:
         try:
             return datetime.fromisoformat(time_str)
@@ -57,81 +159,624 @@ def get_last_cleanup_time() -> datetime:
     return datetime.now()
 
 def set_last_cleanup_time(dt: datetime):
-    config = load_config()
-    config["last_cleanup_time"] = dt.isoformat()
-    save_config(config)
-    
-config = load_config()
+    config_store.update(last_cleanup_time=dt.isoformat())
+
+#region Сегменты лога
+def _log_segments() -> list[str]:
+    """Ротированные сегменты лога от старых к новым (сжатые и ещё не сжатые)"""
+    dirname = os.path.dirname(LOG_PATH) or "."
+    prefix = os.path.basename(LOG_PATH) + "."
+    stems = {}
+    for name in os.listdir(dirname):
+        if not name.startswith(prefix) or name.endswith((".tmp", LOG_INDEX_SUFFIX)):
+            continue
+        stem = name[:-3] if name.endswith(".gz") else name
+        # Пока сегмент сжимается, читаем несжатую копию
+        if stem not in stems or not name.endswith(".gz"):
+            stems[stem] = os.path.join(dirname, name)
+    return [stems[stem] for stem in sorted(stems)]
+
+def _index_path(path: str) -> str:
+    """Файл индекса для лога или сегмента (у сжатого — индекс несжатых смещений)"""
+    return (path[:-3] if path.endswith(".gz") else path) + LOG_INDEX_SUFFIX
+
+_segments_lock = threading.Lock()
+
+def _compress_segment(path: str):
+    """Сжимает сегмент в .gz (через временный файл) и удаляет исходник.
+
+    Число строк сегмента дописывается в его индекс строкой «lines N» —
+    чтобы /logs не распаковывал архив целиком ради подсчёта.
+    """
+    gz_path = path + ".gz"
+    tmp_path = gz_path + ".tmp"
+    count = 0
+    last = b"\n"
+    with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+        for block in iter(lambda: src.read(TAIL_BLOCK_SIZE), b""):
+            dst.write(block)
+            count += block.count(b"\n")
+            last = block[-1:]
+    if last != b"\n":
+        count += 1
+    with open(_index_path(path), "a", encoding="utf-8") as index_file:
+        index_file.write(f"{LOG_INDEX_LINES_TAG} {count}\n")
+    os.replace(tmp_path, gz_path)
+    os.remove(path)
+
+def _apply_retention():
+    """Удаляет сегменты старше LOG_RETENTION_DAYS и сверх LOG_MAX_SEGMENTS"""
+    segments = _log_segments()
+    cutoff = time.time() - LOG_RETENTION_DAYS * 86400
+    for index, path in enumerate(segments):
+        if index < len(segments) - LOG_MAX_SEGMENTS or os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            if os.path.exists(_index_path(path)):
+                os.remove(_index_path(path))
+
+def _maintain_segments():
+    """Дожимает несжатые сегменты (например, после падения) и применяет политику хранения"""
+    with _segments_lock:
+        try:
+            for path in _log_segments():
+                if not path.endswith(".gz"):
+                    _compress_segment(path)
+            _apply_retention()
+        except OSError as e:
+            logging.error("❌ Ошибка при обслуживании сегментов лога: %s", e)
+#endregion
+
+def _level_bit(levelno: int) -> int:
+    """Бит уровня для маски индекса: DEBUG=1, INFO=2, WARNING=4, ERROR=8, CRITICAL=16"""
+    return 1 << min(max(levelno // 10 - 1, 0), 4)
+
+class _DeferredFlushFileHandler(logging.FileHandler):
+    """Файловый обработчик с ротацией по размеру и времени и индексом.
+
+    После каждой записи буфер не сбрасывается — это делает _BatchingQueueListener,
+    когда очередь записей опустела. Пачка пишется одним os.write в файл,
+    открытый на дозапись, поэтому её смещение точно известно даже при нескольких
+    процессах. В файл-спутник bot.log.idx добавляется строка
+    «начало конец время_от время_до маска_уровней» на каждый отрезок лога
+    в пределах LOG_INDEX_BUCKET секунд.
+
+    При сбросе же проверяется ротация: файл переименовывается в сегмент
+    bot.log.<время> (вместе с индексом), который сжимается в отдельном потоке.
+    Ротирует только главный процесс; процессы-обработчики просто переоткрывают
+    файл, если его переименовали.
+    """
+
+    def __init__(self, filename, encoding=None):
+        self._index_file = None
+        self._dev_ino = None
+        super().__init__(filename, encoding=encoding)
+        self._rollover_at = (
+            get_last_cleanup_time() + timedelta(days=CLEAN_INTERVAL_DAYS)
+        ).timestamp()
+        self._buffer: list[bytes] = []
+        self._buffer_meta = None  # [время первой записи, время последней, маска уровней]
+        self._index_entry = None  # [начало, конец, время от, время до, маска, корзина]
+
+    def _open(self):
+        stream = super()._open()
+        st = os.fstat(stream.fileno())
+        self._dev_ino = (st.st_dev, st.st_ino)
+        self._index_file = open(self.baseFilename + LOG_INDEX_SUFFIX, "a", encoding="utf-8")
+        return stream
+
+    def _close_files(self):
+        self._write_index_entry()
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            text = self.format(record) + self.terminator
+            self._buffer.append(text.encode(self.encoding or "utf-8", errors="replace"))
+            meta = self._buffer_meta
+            if meta is None:
+                self._buffer_meta = [record.created, record.created, _level_bit(record.levelno)]
+            else:
+                meta[1] = record.created
+                meta[2] |= _level_bit(record.levelno)
+        except Exception:
+            self.handleError(record)
+
+    def _write_buffer(self):
+        if not self._buffer or self.stream is None:
+            return
+        data = b"".join(self._buffer)
+        meta = self._buffer_meta
+        self._buffer, self._buffer_meta = [], None
+
+        fd = self.stream.fileno()
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        end = os.lseek(fd, 0, os.SEEK_CUR)
+        self._index_chunk(end - len(data), end, *meta)
+
+    def _index_chunk(self, start: int, end: int, ts_min: float, ts_max: float, mask: int):
+        bucket = int(ts_min // LOG_INDEX_BUCKET)
+        entry = self._index_entry
+        if entry is not None and entry[1] == start and entry[5] == bucket:
+            entry[1] = end
+            entry[3] = ts_max
+            entry[4] |= mask
+            return
+        self._write_index_entry()
+        self._index_entry = [start, end, ts_min, ts_max, mask, bucket]
+
+    def _write_index_entry(self):
+        """Дописывает накопленный отрезок в индекс.
+
+        Незаписанный хвост не теряется: запросы читают неиндексированные участки целиком.
+        """
+        entry = self._index_entry
+        self._index_entry = None
+        if entry is None or self._index_file is None:
+            return
+        start, end, ts_min, ts_max, mask, _ = entry
+        self._index_file.write(f"{start} {end} {int(ts_min)} {int(ts_max) + 1} {mask}\n")
+        self._index_file.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._write_buffer()
+            self._check_file()
+        except OSError:
+            pass
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._write_buffer()
+            self._close_files()
+        except OSError:
+            pass
+        finally:
+            self.release()
+        super().close()
+
+    def _check_file(self):
+        try:
+            st = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            st = None
+        if st is None or (st.st_dev, st.st_ino) != self._dev_ino:
+            # Файл ротировал другой процесс — пишем в новый
+            self._close_files()
+            return
+        if st.st_size >= LOG_MAX_BYTES or time.time() >= self._rollover_at:
+            self.do_rollover()
+
+    def do_rollover(self):
+        """Переносит текущий файл в сегмент и начинает новый (под блокировкой обработчика)"""
+        self._write_buffer()
+        self._close_files()
+
+        segment = None
+        index_path = self.baseFilename + LOG_INDEX_SUFFIX
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            segment = f"{self.baseFilename}.{datetime.now():%Y%m%d-%H%M%S-%f}"
+            os.rename(self.baseFilename, segment)
+            if os.path.exists(index_path):
+                os.rename(index_path, segment + LOG_INDEX_SUFFIX)
+        elif os.path.exists(index_path):
+            os.remove(index_path)
+
+        now = datetime.now()
+        self._rollover_at = (now + timedelta(days=CLEAN_INTERVAL_DAYS)).timestamp()
+        set_last_cleanup_time(now)
+        if segment:
+            threading.Thread(target=_maintain_segments, name="log-compress", daemon=True).start()
+
+class _BatchingQueueListener(logging.handlers.QueueListener):
+    """Пишет записи из очереди в фоновом потоке и сбрасывает файлы пачками"""
+
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование %-шаблона и traceback
+    выполняет поток QueueListener, а не обработчик апдейта"""
+
+    def prepare(self, record):
+        return record
+
+_log_listener: _BatchingQueueListener | None = None
+_log_file_handler: _DeferredFlushFileHandler | None = None
 
 def init_logging():
+    """Настраивает логирование через очередь.
+
+    В потоке обработчиков остаётся только QueueHandler (положить запись в очередь),
+    а запись в файл и в консоль идёт в отдельном потоке QueueListener.
+    """
+    global _log_listener, _log_file_handler
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
     # Удаляем старые обработчики
     if logger.hasHandlers():
         logger.handlers.clear()
-
-    # 🔹 Файл логов
-    file_handler = logging.FileHandler(LOG_PATH, encoding="utf-8")
-    formatter = logging.Formatter(
-        fmt="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d | %H:%M:%S"  # ⬅️ Вот здесь убраны миллисекунды
-        )
-    file_handler.setFormatter(formatter)
-
+    stop_logging()
 
     # 🔹 Консоль (терминал)
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(logging.Formatter("%(levelname)s - %(message)s"))
-
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    handlers = [console_handler]
+
+    # 🔹 Файл логов. Пишет и ротирует его только главный процесс: процессы-обработчики
+    # пересылают записи ему (init_worker_logging), иначе после ротации они
+    # продолжали бы писать в уже переименованный и сжимаемый сегмент
+    if multiprocessing.parent_process() is None:
+        file_handler = _DeferredFlushFileHandler(LOG_PATH, encoding="utf-8")
+        formatter = logging.Formatter(
+            fmt="%(asctime)s - %(levelname)s - %(message)s",
+            datefmt="%Y-%m-%d | %H:%M:%S"  # ⬅️ Вот здесь убраны миллисекунды
+            )
+        file_handler.setFormatter(formatter)
+        _log_file_handler = file_handler
+        handlers.insert(0, file_handler)
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_LazyQueueHandler(log_queue))
+    _log_listener = _BatchingQueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _log_listener.start()
+    # Дописываем хвост очереди при выходе из процесса
+    atexit.register(stop_logging)
 
     return logger
 
-async def start_log_cleanup_cycle():
-    start_time = datetime.now()
-    notified = False  # Было ли уже отправлено предупреждение
+def stop_logging():
+    """Останавливает фоновый поток логирования, дописав всё из очереди"""
+    global _log_listener, _worker_log_listener
+    for listener in (_worker_log_listener, _log_listener):
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.flush()
+    _log_listener = _worker_log_listener = None
+
+#region Логи процессов-обработчиков
+_worker_log_listener: _BatchingQueueListener | None = None
+
+def start_worker_log_forwarding(log_queue):
+    """Главный процесс: пишет записи процессов-обработчиков теми же обработчиками
+    (файл и консоль), что и свои. log_queue — multiprocessing.Queue"""
+    global _worker_log_listener
+    if _log_listener is None:
+        return
+    _worker_log_listener = _BatchingQueueListener(
+        log_queue, *_log_listener.handlers, respect_handler_level=True
+    )
+    _worker_log_listener.start()
+
+def init_worker_logging(log_queue):
+    """Процесс-обработчик: все записи уходят в главный процесс через log_queue.
+
+    Обычный QueueHandler форматирует запись перед отправкой, чтобы она
+    пережила pickle (аргументы и traceback становятся текстом).
+    """
+    logger = logging.getLogger()
+    logger.handlers.clear()
+    stop_logging()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+#endregion
+
+def rotate_log_now():
+    """Принудительная ротация: текущий лог уходит в сжатый сегмент, история сохраняется"""
+    handler = _log_file_handler
+    if handler is None:
+        return
+    handler.acquire()
+    try:
+        handler.do_rollover()
+    finally:
+        handler.release()
+
+def _maintain_logs():
+    handler = _log_file_handler
+    if handler is not None:
+        # Ротация по времени, даже если в лог давно ничего не писали
+        handler.flush()
+    _maintain_segments()
 
+async def start_log_cleanup_cycle():
+    """Периодически проверяет ротацию лога и удаляет устаревшие сегменты"""
     while True:
-        now = datetime.now()
-        time_passed = now - start_time
-        time_until_clean = timedelta(days=CLEAN_INTERVAL_DAYS) - time_passed
-
-        # 📢 Уведомление за 24 часа до очистки
-        if not notified and time_until_clean <= timedelta(days=1):
-            '''
-            await message.answer(
-                f"📢 Через 24 часа лог-файл будет автоматически очищен!\n"
-                f"🕓 Время очистки: {start_time + timedelta(days=7):%Y-%m-%d %H:%M}"
-            )
-            notified = True
-            '''
-        # 🧹 Очистка, если прошло 7 дней
-        if time_passed >= timedelta(days=CLEAN_INTERVAL_DAYS):
-            if os.path.exists(LOG_PATH):
-                with open(LOG_PATH, "w", encoding="utf-8") as f:
-                    f.write("")
-                logging.info("🧹 Лог-файл очищен автоматически.")
-                #await message.answer("🧹 Лог-файл очищен автоматически.")
-            
-           # 🔁 Сброс отсчёта
-            start_time = datetime.now()
-            set_last_cleanup_time(start_time)
-            notified = False
-
-        await asyncio.sleep(3600)  # Проверять раз в час (можно чаще, если хочешь)
-
-def get_last_log_lines(n: int = 100) -> list[str] | None:
-    """Возвращает последние N строк логов из файла."""
-    if not os.path.exists(LOG_PATH):
+        await asyncio.to_thread(_maintain_logs)
+        await asyncio.sleep(LOG_MAINTENANCE_INTERVAL)
+
+def _tail_offset(f, n: int) -> tuple[int, int]:
+    """Смещение начала последних n строк и число строк после него: читаем файл блоками с конца"""
+    end = f.seek(0, os.SEEK_END)
+    pos = end
+    count = 0
+    while pos > 0:
+        size = min(TAIL_BLOCK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        block = f.read(size)
+        # Перевод строки в самом конце файла не начинает новую строку
+        if pos + size == end and block.endswith(b"\n"):
+            block = block[:-1]
+        idx = len(block)
+        while (idx := block.rfind(b"\n", 0, idx)) != -1:
+            count += 1
+            if count == n:
+                return pos + idx + 1, n
+    return 0, count + 1 if end else 0
+
+def _count_lines(path: str) -> int:
+    """Число строк сжатого сегмента: из индекса, а если его там нет — распаковкой"""
+    try:
+        with open(_index_path(path), "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[0] == LOG_INDEX_LINES_TAG and parts[1].isdigit():
+                    return int(parts[1])
+    except FileNotFoundError:
+        pass
+    with gzip.open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+def _tail_plan(n: int) -> list[tuple[str, int, int]]:
+    """Откуда читать последние n строк с учётом сегментов.
+
+    Возвращает [(путь, смещение в байтах, строк пропустить)] от старых к новым:
+    для текущего и несжатых файлов — смещение, для .gz — сколько строк пропустить.
+    """
+    plan = []
+    remaining = n
+    for path in [LOG_PATH] + _log_segments()[::-1]:
+        if remaining <= 0:
+            break
+        try:
+            if path.endswith(".gz"):
+                total = _count_lines(path)
+                take = min(total, remaining)
+                plan.append((path, 0, total - take))
+            else:
+                with open(path, "rb") as f:
+                    offset, take = _tail_offset(f, remaining)
+                plan.append((path, offset, 0))
+        except FileNotFoundError:
+            # Сегмент удалили или сжали между листингом и чтением
+            continue
+        remaining -= take
+    return plan[::-1]
+
+def _open_planned(path: str, offset: int, skip: int):
+    if path.endswith(".gz"):
+        f = gzip.open(path, "rb")
+        return f, islice(f, skip, None)
+    f = open(path, "rb")
+    f.seek(offset)
+    return f, iter(lambda: f.read(TAIL_BLOCK_SIZE), b"")
+
+def _read_tail_lines(n: int) -> list[str]:
+    lines = []
+    for path, offset, skip in _tail_plan(n):
+        f, chunks = _open_planned(path, offset, skip)
+        with f:
+            data = b"".join(chunks)
+        lines.extend(data.decode("utf-8", errors="ignore").splitlines(keepends=True))
+    return lines[-n:] if n else []
+
+def _copy_tail_to_file(n: int) -> str:
+    with NamedTemporaryFile("wb", delete=False, suffix=".log") as dst:
+        for path, offset, skip in _tail_plan(n):
+            f, chunks = _open_planned(path, offset, skip)
+            with f:
+                for chunk in chunks:
+                    dst.write(chunk)
+        return dst.name
+
+#region Запросы к логу по индексу
+_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING,
+           "error": logging.ERROR, "critical": logging.CRITICAL}
+_RECORD_START = re.compile(rb"^(\d{4}-\d{2}-\d{2} \| \d{2}:\d{2}:\d{2}) - (\w+) - ")
+_RELATIVE_TIME = re.compile(r"^(\d+)([mhd])$")
+
+def _parse_query_time(value: str) -> datetime:
+    """«30m», «2h», «3d» — столько назад; иначе ISO-дата или дата-время"""
+    match = _RELATIVE_TIME.match(value)
+    if match:
+        units = {"m": "minutes", "h": "hours", "d": "days"}
+        return datetime.now() - timedelta(**{units[match.group(2)]: int(match.group(1))})
+    return datetime.fromisoformat(value)
+
+def parse_log_query(args: list[str]) -> dict:
+    """Разбирает аргументы /logs: [N] [level:уровень] [since:время] [until:время] [user:id] [текст...]
+
+    level — этот уровень и выше; время — «2h», «30m», «3d» или ISO («2024-05-01T12:00»).
+    Бросает ValueError при неверном значении.
+    """
+    query = {"limit": 100, "min_level": None, "since": None, "until": None, "user_id": None, "text": None}
+    words = []
+    for index, arg in enumerate(args):
+        key, _, value = arg.partition(":")
+        if index == 0 and arg.isdigit():
+            query["limit"] = int(arg)
+        elif key == "level" and value.lower() in _LEVELS:
+            query["min_level"] = _LEVELS[value.lower()]
+        elif key == "since" and value:
+            query["since"] = _parse_query_time(value)
+        elif key == "until" and value:
+            query["until"] = _parse_query_time(value)
+        elif key == "user" and value.isdigit():
+            query["user_id"] = int(value)
+        elif key in ("level", "since", "until", "user"):
+            raise ValueError(arg)
+        else:
+            words.append(arg)
+    if words:
+        query["text"] = " ".join(words)
+    return query
+
+def _load_index(path: str) -> list[tuple[int, int, int, int, int]] | None:
+    try:
+        with open(_index_path(path), "r", encoding="utf-8") as f:
+            entries = []
+            for line in f:
+                parts = line.split()
+                if len(parts) == 5 and all(p.isdigit() for p in parts):
+                    entries.append(tuple(map(int, parts)))
+    except FileNotFoundError:
+        return None
+    entries.sort()
+    return entries
+
+def _matches_index(entry, since: float | None, until: float | None, mask: int) -> bool:
+    _, _, ts_min, ts_max, levels = entry
+    return (
+        (since is None or ts_max >= since)
+        and (until is None or ts_min <= until)
+        and bool(levels & mask)
+    )
+
+def _index_ranges(entries, size: int, since, until, mask) -> list[tuple[int, int]]:
+    """Байтовые отрезки, которые нужно прочитать: подходящие по индексу и неиндексированные"""
+    ranges = []
+    pos = 0
+    for entry in entries:
+        start, end = entry[0], entry[1]
+        if start > pos:
+            ranges.append((pos, start))
+        if _matches_index(entry, since, until, mask):
+            ranges.append((start, end))
+        pos = max(pos, end)
+    if pos < size:
+        ranges.append((pos, size))
+
+    merged = []
+    for start, end in ranges:
+        if merged and merged[-1][1] >= start:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _read_ranges(path: str, ranges):
+    with open(path, "rb") as f:
+        for start, end in ranges:
+            f.seek(start)
+            remaining = end - start
+            tail = b""
+            while remaining > 0:
+                block = f.read(min(TAIL_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                lines = (tail + block).split(b"\n")
+                tail = lines.pop()
+                for line in lines:
+                    yield line + b"\n"
+            if tail:
+                yield tail
+
+def _iter_query_lines(since, until, mask):
+    """Строки лога, которые могут подойти под запрос, с пропуском лишнего по индексу"""
+    for path in _log_segments() + [LOG_PATH]:
+        entries = _load_index(path)
+        try:
+            if path.endswith(".gz"):
+                # Сжатый сегмент не перемотать — пропускаем его целиком, если индекс позволяет
+                if entries and not any(_matches_index(e, since, until, mask) for e in entries):
+                    continue
+                with gzip.open(path, "rb") as f:
+                    yield from f
+            else:
+                size = os.path.getsize(path)
+                ranges = _index_ranges(entries or [], size, since, until, mask)
+                yield from _read_ranges(path, ranges)
+        except FileNotFoundError:
+            continue
+
+def _iter_records(lines):
+    """Склеивает строки в записи: продолжения (traceback) идут за строкой с датой"""
+    record = None
+    for line in lines:
+        if _RECORD_START.match(line):
+            if record:
+                yield record
+            record = [line]
+        elif record is not None:
+            record.append(line)
+    if record:
+        yield record
+
+def _query_logs(query: dict) -> list[str]:
+    since = query["since"].timestamp() if query["since"] else None
+    until = query["until"].timestamp() if query["until"] else None
+    min_level = query["min_level"] or logging.DEBUG
+    mask = sum(_level_bit(level) for level in _LEVELS.values() if level >= min_level)
+    text = query["text"].lower().encode("utf-8") if query["text"] else None
+    user_re = re.compile(rb"(?<!\d)%d(?!\d)" % query["user_id"]) if query["user_id"] else None
+
+    matches = deque(maxlen=query["limit"])
+    for record in _iter_records(_iter_query_lines(since, until, mask)):
+        match = _RECORD_START.match(record[0])
+        level = logging.getLevelName(match.group(2).decode())
+        if isinstance(level, int) and level < min_level:
+            continue
+        if since is not None or until is not None:
+            ts = datetime.strptime(match.group(1).decode(), "%Y-%m-%d | %H:%M:%S").timestamp()
+            if (since is not None and ts < since) or (until is not None and ts > until):
+                continue
+        body = b"".join(record)
+        if user_re and not user_re.search(body):
+            continue
+        if text and text not in body.lower():
+            continue
+        matches.append(body.decode("utf-8", errors="ignore"))
+    return list(matches)
+
+async def query_logs(query: dict) -> list[str]:
+    """Последние query["limit"] записей лога, подходящих под запрос (см. parse_log_query)"""
+    return await asyncio.to_thread(_query_logs, query)
+#endregion
+
+async def get_last_log_lines(n: int = 100) -> list[str] | None:
+    """Возвращает последние N строк логов (с учётом ротированных сегментов).
+
+    Память и время зависят от N, а не от размера файла; чтение идёт в потоке.
+    """
+    if not os.path.exists(LOG_PATH) and not _log_segments():
+        logging.warning("⚠️ Лог-файл не найден.")
+        return None
+
+    try:
+        return await asyncio.to_thread(_read_tail_lines, n)
+    except Exception as e:
+        logging.exception("❌ Ошибка при чтении логов:")
+        return None
+
+async def write_log_tail_to_file(n: int = 100) -> str | None:
+    """Копирует последние N строк во временный файл потоком, не держа их в памяти"""
+    if not os.path.exists(LOG_PATH) and not _log_segments():
         logging.warning("⚠️ Лог-файл не найден.")
         return None
 
     try:
-        with open(LOG_PATH, "r", encoding="utf-8", errors="ignore") as f:
-            all_lines = f.readlines()
-        return all_lines[-n:]
+        return await asyncio.to_thread(_copy_tail_to_file, n)
     except Exception as e:
         logging.exception("❌ Ошибка при чтении логов:")
         return None
@@ -151,27 +796,67 @@ async def send_logs(event: types.Message | CallbackQuery):
     args = message.text.split() if message.text else []
     lines = int(args[1]) if len(args) > 1 and args[1].isdigit() else 100
 
-    tail = get_last_log_lines(lines)
-    if tail is None:
+    # Фильтры (level:, since:, until:, user:, текст) — поиск по индексу вместо хвоста
+    if isinstance(event, types.Message) and any(not arg.isdigit() for arg in args[1:]):
+        await send_log_query(message, args[1:])
+        return
+
+    temp_path = await write_log_tail_to_file(lines)
+    if temp_path is None:
+        await message.answer("⚠️ Не удалось прочитать лог-файл.")
+        return
+
+    try:
+        await message.answer_document(
+            FSInputFile(temp_path),
+            caption=(
+                f"🧾 Последние {lines} строк логов\n"
+                "Если нужно больше, отправьте команду: /logs [кол-во строк].\n"
+                "Поиск: /logs [N] level:error since:2h until:2024-05-01T12:00 user:123 [текст]"
+            ),
+            parse_mode=None,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="📄 Вывести в сообщение", callback_data="logs_as_text")]
+            ])
+        )
+    finally:
+        os.remove(temp_path)
+
+async def send_log_query(message: types.Message, args: list[str]):
+    """Отправляет записи лога, подходящие под фильтры /logs"""
+    try:
+        query = parse_log_query(args)
+    except ValueError as e:
+        await message.answer(
+            f"⚠️ Не понял фильтр: {e}\n"
+            "Формат: /logs [N] level:error since:2h until:2024-05-01T12:00 user:123 [текст]",
+            parse_mode=None
+        )
+        return
+
+    try:
+        records = await query_logs(query)
+    except Exception:
+        logging.exception("❌ Ошибка при поиске по логам:")
         await message.answer("⚠️ Не удалось прочитать лог-файл.")
         return
 
-    with NamedTemporaryFile("w+", delete=False, suffix=".log", encoding="utf-8") as temp_file:
-        temp_file.writelines(tail)
+    if not records:
+        await message.answer("🔍 По запросу ничего не найдено.")
+        return
+
+    with NamedTemporaryFile("w", delete=False, suffix=".log", encoding="utf-8") as temp_file:
+        temp_file.writelines(records)
         temp_path = temp_file.name
 
-    await message.answer_document(
-        FSInputFile(temp_path),
-        caption=(
-            f"🧾 Последние {lines} строк логов\n"
-            "Если нужно больше, отправьте команду: /logs [кол-во строк]."
-        ),
-        parse_mode=None,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📄 Вывести в сообщение", callback_data="logs_as_text")]
-        ])
-    )
-    os.remove(temp_path)
+    try:
+        await message.answer_document(
+            FSInputFile(temp_path),
+            caption=f"🔍 Найдено записей: {len(records)} (показаны последние, не больше {query['limit']})",
+            parse_mode=None
+        )
+    finally:
+        os.remove(temp_path)
 
 @logs_router.callback_query(F.data == "logs_as_text")
 async def send_logs_as_text(call: CallbackQuery):
@@ -179,12 +864,7 @@ async def send_logs_as_text(call: CallbackQuery):
         await call.answer("❌ Недостаточно прав.", show_alert=True)
         return
 
-    log_file_path = "bot.log"
-    if not os.path.exists(log_file_path):
-        await call.message.edit_text("⚠️ Лог-файл не найден.")
-        return
-
-    tail = get_last_log_lines(100)
+    tail = await get_last_log_lines(100)
     if tail is None:
         await call.message.edit_text("⚠️ Не удалось прочитать лог-файл.")
         return
@@ -238,10 +918,13 @@ async def clear_logs(event: types.Message | CallbackQuery):
     hours, remainder = divmod(int(remaining.total_seconds()), 3600)
     minutes = remainder // 60
 
+    size_mb = os.path.getsize(LOG_PATH) / (1024 * 1024) if os.path.exists(LOG_PATH) else 0
     warn_text = (
-        f"🧹 До автоматической очистки логов осталось: "
-        f"<b>{hours} ч {minutes} мин</b>\n\n"
-        f"Вы уверены, что хотите очистить логи вручную сейчас?"
+        f"🧹 До плановой ротации логов осталось: "
+        f"<b>{hours} ч {minutes} мин</b> "
+        f"(или по достижении {LOG_MAX_BYTES // (1024 * 1024)} МБ, сейчас {size_mb:.1f} МБ)\n"
+        f"Сжатых сегментов: {len(_log_segments())}, хранятся {LOG_RETENTION_DAYS} дн.\n\n"
+        f"Очистить текущий лог сейчас? Он будет перенесён в сжатый сегмент, история сохранится."
     )
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -257,13 +940,12 @@ async def confirm_clearlog(call: CallbackQuery):
         await call.answer("❌ Недостаточно прав.", show_alert=True)
         return
 
-    log_file = "bot.log"
-    if os.path.exists(log_file):
-        with open(log_file, "w", encoding="utf-8") as f:
-            f.write("")
-        await call.message.edit_text("🧹 Лог-файл был очищен вручную!")
-    else:
+    if _log_file_handler is None:
         await call.message.edit_text("⚠️ Лог-файл не найден.")
+        return
+
+    await asyncio.to_thread(rotate_log_now)
+    await call.message.edit_text("🧹 Лог-файл очищен вручную, прежние записи перенесены в сжатый сегмент.")
 
 
 @logs_router.callback_query(lambda c: c.data == "cancel_clearlog")
@@ -1,5 +1,8 @@
+import asyncio
+import sys
 
 from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.memory import MemoryStorage
 
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
@@ -8,21 +11,40 @@ from aiogram.dispatcher.middlewares.base import BaseMiddleware
 from aiogram.types import Update
 from typing import Callable, Awaitable, Dict, Any
 
-from init import BOT_TOKEN, logging
-from db.db_main import create_table, init_db_pool, close_db, get_pool
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from log import start_log_cleanup_cycle, logs_router, init_logging
-from users.user import user_router
+from init import (
+    BOT_TOKEN, logging, FSM_STORAGE,
+    BOT_MODE, BOT_WORKERS, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_BASE_URL, WEBHOOK_SECRET
+)
+from db.db_main import init_db_pool, close_db, get_pool
+from db.migrations import run_migrations
+from db.clock import sync_db_clock, start_db_clock_sync_cycle
+from db.fsm_storage import PostgresStorage
+
+from handlers.charts import start_chart_workers, shutdown_chart_workers
+from log import (
+    start_log_cleanup_cycle, logs_router, init_logging,
+    init_worker_logging, start_worker_log_forwarding
+)
+from users.user import user_router, get_or_create_user
+from users.activity import flush_activity, start_activity_flush_cycle
 from handlers.start import start_router
 from handlers.stats import stats_router
 from expense.expense_main import expense_router
 from expense.expense_delete import expense_delete_router
 from expense.expense_history import expense_history_router
 from expense.category import category_router
+from workers import WorkerPool, WorkerStartupError, consume_updates
+from outbound import OutboundLimiter
 
 # Инициализация бота
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+# Все исходящие запросы проходят через лимиты и склейку правок
+bot.session.middleware(OutboundLimiter())
+storage = PostgresStorage() if FSM_STORAGE == "postgres" else MemoryStorage()
+dp = Dispatcher(storage=storage)
 
 logger = init_logging()
 
@@ -51,58 +73,221 @@ class UserActivityMiddleware(BaseMiddleware):
             logging.warning("⚠️ Не удалось определить пользователя. Пропускаю событие.")
             return await handler(event, data)
 
-        # Добавляем/обновляем пользователя в базе
-        try:
-            db_pool = get_pool()
+        # Добавляем/обновляем пользователя в базе (для известных — без запросов)
+        await get_or_create_user(user)
 
-            exists = await db_pool.fetchval(
-                "SELECT 1 FROM users WHERE user_id = $1",
-                user.id
-            )
-            
-            if not exists:
-                await db_pool.execute(
-                    "INSERT INTO users (user_id, username, first_name, last_name) "
-                    "VALUES ($1, $2, $3, $4)",
-                    user.id,
-                    user.username,
-                    user.first_name,
-                    user.last_name
-                )
-                logging.info(f"🆕 Пользователь {user.full_name} (ID: {user.id}) добавлен в базу.")
-
-            await db_pool.execute(
-                "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = $1",
-                user.id
+        return await handler(event, data)
+# Добавляем в диспетчер
+dp.update.middleware(UserActivityMiddleware())
+
+async def run_polling():
+    """Получение обновлений long polling'ом"""
+    await bot.delete_webhook(drop_pending_updates=True)  # Очищаем неотправленные сообщения
+    logging.info("🚀 Бот начинает работу (polling)...")
+    await dp.start_polling(bot)
+
+async def run_webhook():
+    """Получение обновлений через вебхук на aiohttp-сервере.
+
+    Telegram получает ответ сразу, а обновления обрабатываются параллельно в фоне.
+    Локально можно проверить, отправляя сохранённые обновления POST-запросом на
+    WEBHOOK_PATH с заголовком X-Telegram-Bot-Api-Secret-Token.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+
+    try:
+        if WEBHOOK_BASE_URL:
+            # Накопившиеся обновления не сбрасываем — они придут после перезапуска
+            await bot.set_webhook(
+                f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                drop_pending_updates=False
             )
+        else:
+            logging.warning("⚠️ WEBHOOK_BASE_URL не задан, вебхук в Telegram не регистрируется")
+
+        logging.info("🚀 Бот начинает работу (webhook на %s:%s%s)...", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 
+async def startup():
+    """Подключает роутеры, БД и фоновые задачи процесса, который обрабатывает апдейты"""
+    start_chart_workers()
+    # Подключаем роутеры
+    for router in all_routers:
+        dp.include_router(router)
+    await init_db_pool()
+    await run_migrations()
+    # Соединения переподготовят запросы каталога уже на новой схеме
+    await get_pool().expire_connections()
+    logging.info("✅ База данных подключена.")
+    await sync_db_clock()
+    asyncio.create_task(start_activity_flush_cycle())
+    asyncio.create_task(start_db_clock_sync_cycle())
+    if isinstance(storage, PostgresStorage):
+        storage.start()
+
+async def shutdown():
+    """Сохраняет накопленные данные и закрывает ресурсы процесса"""
+    try:
+        await dp.shutdown()
+    except Exception as e:
+        logging.error("⚠️ Ошибка при завершении диспетчера: %s", e)
+
+    try:
+        await storage.close()
+    except Exception as e:
+        logging.error("⚠️ Ошибка при сохранении состояний FSM: %s", e)
+
+    try:
+        await flush_activity()
+    except Exception as e:
+        logging.error("⚠️ Ошибка при сохранении активности пользователей: %s", e)
+
+    shutdown_chart_workers()
+
+    try:
+        await close_db()
+    except Exception as e:
+        logging.error("⚠️ Ошибка при закрытии соединения с БД: %s", e)
+
+#region Режим нескольких процессов (BOT_WORKERS > 1)
+async def _worker_main(queue, ready) -> bool:
+    try:
+        await startup()
+    except Exception as e:
+        logging.critical("❌ Ошибка подключения к БД: %s", e, exc_info=True)
+        return False
+    try:
+        await dp.emit_startup(bot=bot)
+        # Фронт ждёт этого сигнала и только тогда начинает принимать апдейты
+        ready.set()
+        await consume_updates(queue, lambda raw: dp.feed_raw_update(bot, raw))
+    finally:
+        await shutdown()
+        await bot.session.close()
+    return True
+
+def worker_process(index: int, queue, log_queue, ready):
+    """Точка входа процесса-обработчика: получает апдейты от фронта через очередь"""
+    init_worker_logging(log_queue)
+    logging.info("👷 Обработчик #%s запущен", index)
+    try:
+        if not asyncio.run(_worker_main(queue, ready)):
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+async def run_front_polling(pool: WorkerPool):
+    """Фронт: забирает апдейты long polling'ом и раздаёт их обработчикам"""
+    await bot.delete_webhook(drop_pending_updates=True)
+    logging.info("🚀 Бот начинает работу (polling, обработчиков: %s)...", pool.size)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30)
         except Exception as e:
-            logging.error(f"❌ Ошибка при обработке пользователя в middleware: {e}")
+            logging.error("⚠️ Ошибка получения обновлений: %s", e)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            pool.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
 
-        return await handler(event, data)
-# Добавляем в диспетчер
-dp.update.middleware(UserActivityMiddleware())
+async def run_front_webhook(pool: WorkerPool):
+    """Фронт: принимает вебхук и раздаёт «сырые» апдейты обработчикам без разбора"""
+    async def handle(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        pool.route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+
+    try:
+        if WEBHOOK_BASE_URL:
+            await bot.set_webhook(
+                f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                drop_pending_updates=False
+            )
+        else:
+            logging.warning("⚠️ WEBHOOK_BASE_URL не задан, вебхук в Telegram не регистрируется")
+
+        logging.info("🚀 Бот начинает работу (webhook, обработчиков: %s)...", pool.size)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
+async def run_front():
+    """Запускает обработчики и фронт; сам фронт к БД не подключается"""
+    pool = WorkerPool(BOT_WORKERS, worker_process)
+    start_worker_log_forwarding(pool.log_queue)
+    try:
+        # Ждём готовности всех обработчиков: при ошибке запуска фронт не стартует
+        await asyncio.to_thread(pool.start)
+        front = asyncio.create_task(
+            run_front_webhook(pool) if BOT_MODE == "webhook" else run_front_polling(pool)
+        )
+        supervisor = asyncio.create_task(pool.supervise())
+        try:
+            done, _ = await asyncio.wait({front, supervisor}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            front.cancel()
+            supervisor.cancel()
+        for task in done:
+            task.result()
+    finally:
+        # join блокирующий — ждём обработчики вне цикла событий
+        await asyncio.to_thread(pool.stop)
+        await bot.session.close()
+#endregion
 
 async def main():
     """Основная функция запуска бота""" 
     logging.info("🔄 Запуск бота...")
     asyncio.create_task(start_log_cleanup_cycle())
-    # Подключаем роутеры
-    for router in all_routers:
-        dp.include_router(router)
+    if BOT_WORKERS > 1:
+        try:
+            await run_front()
+        except asyncio.CancelledError:
+            logging.warning("⏹️ Бот остановлен вручную (Ctrl+C)")
+        except WorkerStartupError as e:
+            logging.critical("❌ %s. Бот остановлен.", e)
+            sys.exit(1)
+        logging.info("✅ Все обработчики остановлены. Бот остановлен.")
+        return
+
     try:
-        await init_db_pool()
-        await create_table()
-        logging.info("✅ База данных подключена.")
+        await startup()
     except Exception as e:
-        logging.critical(f"❌ Ошибка подключения к БД: {e}", exc_info=True)
+        logging.critical("❌ Ошибка подключения к БД: %s", e, exc_info=True)
         return
     
     try:
-        await bot.delete_webhook(drop_pending_updates=True)  # Очищаем неотправленные сообщения
-        logging.info("🚀 Бот начинает работу...")
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
 
     except asyncio.CancelledError:
         logging.warning("⏹️ Бот остановлен вручную (Ctrl+C)")
@@ -112,19 +297,9 @@ async def main():
 
     finally:
         logging.info("🔻 Завершение работы бота...")
-        try:
-            await dp.shutdown()
-        except Exception as e:
-            logging.error(f"⚠️ Ошибка при завершении диспетчера: {e}")
-
-        try:
-            await close_db()
-        except Exception as e:
-            logging.error(f"⚠️ Ошибка при закрытии соединения с БД: {e}")
-
+        await shutdown()
         logging.info("✅ Все ресурсы закрыты. Бот остановлен.")
     
 if __name__ == '__main__':
-    import asyncio
     asyncio.run(main())
 #endregion
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    TelegramMethod, SendMessage, SendPhoto, SendDocument, SendMediaGroup,
+    CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup, EditMessageMedia
+)
+
+from init import (
+    logging, BOT_WORKERS,
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE
+)
+
+OUTBOUND_MAX_RETRIES = 3
+CHAT_BUCKETS_MAX_SIZE = 10000
+
+# Методы, на которые действуют лимиты Telegram на отправку
+_LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendDocument, SendMediaGroup, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup, EditMessageMedia,
+)
+# Правки одного сообщения, из которых достаточно отправить последнюю
+_EDIT_METHODS = (EditMessageText, EditMessageCaption, EditMessageReplyMarkup, EditMessageMedia)
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def reserve(self) -> float:
+        """Забирает токен (в долг, если нужно) и возвращает, сколько секунд подождать"""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(wait, self._paused_until - now)
+
+    def pause(self, seconds: float):
+        """Запрещает отправку на seconds секунд (после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        return self._tokens >= self.capacity and self._paused_until <= time.monotonic()
+
+class _PendingEdit:
+    __slots__ = ("method", "future")
+
+    def __init__(self, method: TelegramMethod):
+        self.method = method
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Планировщик исходящих запросов к Telegram.
+
+    Держит общий лимит и лимит на чат, склеивает ожидающие правки одного
+    сообщения (уходит только самая свежая) и повторяет запрос после RetryAfter.
+    Остальные методы (answer_callback_query и т.п.) проходят без задержек.
+    """
+
+    def __init__(self):
+        # Лимит Telegram общий на бота — делим его между процессами-обработчиками
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE / BOT_WORKERS, OUTBOUND_GLOBAL_RATE / BOT_WORKERS)
+        self._chats: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self._edits: dict[tuple, _PendingEdit] = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # В группах лимит строже: около 20 сообщений в минуту
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = OUTBOUND_GROUP_RATE if is_group else OUTBOUND_CHAT_RATE
+            bucket = TokenBucket(rate, OUTBOUND_CHAT_BURST)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > CHAT_BUCKETS_MAX_SIZE:
+                # Вытесняем самые давние чаты, если их вёдра уже восстановились
+                for old_id in list(self._chats)[:len(self._chats) - CHAT_BUCKETS_MAX_SIZE]:
+                    if self._chats[old_id].idle:
+                        del self._chats[old_id]
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_turn(self, chat_bucket: Optional[TokenBucket]):
+        wait = chat_bucket.reserve() if chat_bucket else 0.0
+        if wait > 0:
+            await asyncio.sleep(wait)
+        wait = self._global.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _send(self, make_request, bot: Bot, method: TelegramMethod, chat_bucket: Optional[TokenBucket]):
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                logging.warning(
+                    "⏳ Telegram просит подождать %s с (%s, попытка %s)",
+                    e.retry_after, type(method).__name__, attempt + 1
+                )
+                # Пауза на чат — если известен, иначе на всё ведро
+                (chat_bucket or self._global).pause(e.retry_after)
+                await self._wait_turn(chat_bucket)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        if not isinstance(method, _LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+
+        if not isinstance(method, _EDIT_METHODS):
+            await self._wait_turn(chat_bucket)
+            return await self._send(make_request, bot, method, chat_bucket)
+
+        key = (type(method), chat_id, method.message_id, method.inline_message_id)
+        pending = self._edits.get(key)
+        if pending is not None:
+            # Правка ещё ждёт очереди — подменяем её содержимое на более свежее
+            pending.method = method
+            return await asyncio.shield(pending.future)
+
+        pending = _PendingEdit(method)
+        self._edits[key] = pending
+        try:
+            try:
+                await self._wait_turn(chat_bucket)
+            finally:
+                del self._edits[key]
+            result = await self._send(make_request, bot, pending.method, chat_bucket)
+        except asyncio.CancelledError:
+            pending.future.cancel()
+            raise
+        except Exception as e:
+            # Исключение получат и вызовы, чьи правки были склеены с этой
+            pending.future.set_exception(e)
+            pending.future.exception()
+            raise
+        pending.future.set_result(result)
+        return result
@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+from db.db_main import get_pool
+from init import logging
+
+ACTIVITY_FLUSH_INTERVAL = 5  # секунд между сбросами буфера активности в БД
+
+# user_id -> time.monotonic() последнего события пользователя
+_pending_activity: dict[int, float] = {}
+
+def mark_active(user_id: int):
+    """Запоминает время активности пользователя (запись в БД — отложенная)"""
+    _pending_activity[user_id] = time.monotonic()
+
+async def flush_activity():
+    """Сбрасывает накопленные отметки активности одним UPDATE ... FROM unnest(...)"""
+    global _pending_activity
+    if not _pending_activity:
+        return
+
+    db_pool = get_pool()
+    if not db_pool:
+        return
+
+    batch, _pending_activity = _pending_activity, {}
+    now = time.monotonic()
+    user_ids = list(batch.keys())
+    # Передаём «возраст» события в секундах, чтобы время считалось по часам БД,
+    # как раньше с CURRENT_TIMESTAMP
+    ages = [now - ts for ts in batch.values()]
+
+    try:
+        await db_pool.execute_named("users_touch_activity", user_ids, ages)
+    except Exception as e:
+        logging.error("❌ Ошибка при сохранении активности пользователей: %s", e)
+        # Возвращаем отметки в буфер, не затирая более свежие
+        for user_id, ts in batch.items():
+            if _pending_activity.get(user_id, 0) < ts:
+                _pending_activity[user_id] = ts
+
+async def start_activity_flush_cycle():
+    """Периодически сбрасывает буфер активности в БД"""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        await flush_activity()
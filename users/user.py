@@ -7,43 +7,71 @@ from aiogram.types import (
     CallbackQuery)
 
 import asyncpg
+import time
+from collections import OrderedDict
 
 from db.db_main import get_pool
 from init import logging
+from users.activity import mark_active
 
 user_router = Router()
 
+KNOWN_USERS_MAX_SIZE = 10_000  # сколько пользователей держим в кэше
+KNOWN_USERS_TTL = 3600  # секунд, после которых профиль перепроверяется в БД
+
+# user_id -> ((username, first_name, last_name), время истечения); порядок = LRU
+_known_users: OrderedDict[int, tuple[tuple, float]] = OrderedDict()
+
+def _user_profile(user: types.User) -> tuple:
+    return (
+        user.username[:100] if user.username else None,
+        user.first_name[:100] if user.first_name else None,
+        user.last_name[:100] if user.last_name else None
+    )
+
+def _is_known_user(user_id: int, profile: tuple) -> bool:
+    """Проверяет, что пользователь уже есть в БД с теми же данными профиля"""
+    cached = _known_users.get(user_id)
+    if cached is None:
+        return False
+    cached_profile, expires_at = cached
+    if cached_profile != profile or expires_at < time.monotonic():
+        del _known_users[user_id]
+        return False
+    _known_users.move_to_end(user_id)
+    return True
+
+def _remember_user(user_id: int, profile: tuple):
+    _known_users[user_id] = (profile, time.monotonic() + KNOWN_USERS_TTL)
+    _known_users.move_to_end(user_id)
+    while len(_known_users) > KNOWN_USERS_MAX_SIZE:
+        _known_users.popitem(last=False)
+
 async def get_or_create_user(user: types.User):
+    """Регистрирует пользователя или обновляет его профиль.
+
+    Для уже известных пользователей с неизменным профилем запросов к БД нет.
+    """
+    profile = _user_profile(user)
+    if _is_known_user(user.id, profile):
+        mark_active(user.id)
+        return
+
     db_pool = get_pool()
     if not db_pool:
         logging.error("❌ Ошибка: соединение с базой данных не установлено (pool is None)")
         return
 
     try:
-        exists = await db_pool.fetchval(
-            "SELECT 1 FROM users WHERE user_id = $1",
-            user.id
-        )
-        
-        if not exists:
-            await db_pool.execute(
-                "INSERT INTO users (user_id, username, first_name, last_name) "
-                "VALUES ($1, $2, $3, $4)",
-                user.id,
-                user.username[:100] if user.username else None,
-                user.first_name[:100] if user.first_name else None,
-                user.last_name[:100] if user.last_name else None
-            )
-            logging.info(f"👤 Создан новый пользователь: {user.id}")
-        
-        await db_pool.execute(
-            "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = $1",
-            user.id
-        )
+        inserted = await db_pool.fetchval_named("user_upsert", user.id, *profile)
+        if inserted:
+            logging.info("👤 Создан новый пользователь: %s (ID: %s)", user.full_name, user.id)
+
+        _remember_user(user.id, profile)
     except asyncpg.PostgresError as db_err:
-        logging.error(f"❌ Ошибка базы данных при работе с пользователем {user.id}: {db_err}")
+        logging.error("❌ Ошибка базы данных при работе с пользователем %s: %s", user.id, db_err)
     except Exception as e:
-        logging.exception(f"❌ Неизвестная ошибка при создании или обновлении пользователя {user.id}: {e}")
+        logging.exception("❌ Неизвестная ошибка при создании или обновлении пользователя %s: %s", user.id, e)
 
 @user_router.callback_query(F.data == "profile")
 async def show_profile_callback(call: CallbackQuery):
@@ -60,24 +88,17 @@ async def view_profile(event):
     try:
         user_id = event.from_user.id
 
-        user_data = await db_pool.fetchrow(
-            "SELECT username, first_name, last_name, join_date, last_active "
-            "FROM users WHERE user_id = $1",
-            user_id
-        )
+        user_data = await db_pool.fetchrow_named("user_profile", user_id)
         if not user_data:
             await event.answer("❌ Профиль не найден")  # и message.answer, и call.answer есть
             return
 
-        stats = await db_pool.fetchrow(
-            "SELECT COUNT(*) as total_expenses, SUM(amount) as total_amount "
-            "FROM expenses WHERE user_id = $1",
-            user_id
-        )
+        stats = await db_pool.fetchrow_named("user_totals", user_id)
         first_name = user_data['first_name'] or ''
         last_name = user_data['last_name'] or ''
         username = f"@{user_data['username']}" if user_data['username'] else 'не указан'
-        total_amount = stats['total_amount'] or 0
+        total_expenses = stats['expenses_count'] if stats else 0
+        total_amount = stats['total_amount'] if stats else 0
 
         text = (
             f"👤 <b>Ваш профиль</b>\n"
@@ -86,7 +107,7 @@ async def view_profile(event):
             f"├ Дата регистрации: {user_data['join_date'].strftime('%d.%m.%Y')}\n"
             f"├ Последняя активность: {user_data['last_active'].strftime('%d.%m.%Y %H:%M')}\n"
             f"╰ Статистика:\n"
-            f"  └ Всего расходов: {stats['total_expenses']}\n"
+            f"  └ Всего расходов: {total_expenses}\n"
             f"  └ Общая сумма: {total_amount:.2f} ₽"
         )
 
@@ -102,5 +123,5 @@ async def view_profile(event):
             await event.answer(text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
 
     except Exception as e:
-        logging.error(f"❌ Ошибка при получении профиля: {e}")
+        logging.error("❌ Ошибка при получении профиля: %s", e)
         await event.answer("❌ Ошибка при получении профиля")
\ No newline at end of file
@@ -0,0 +1,185 @@
+import asyncio
+import multiprocessing
+import threading
+from collections import deque
+from queue import Empty
+from typing import Awaitable, Callable, Optional
+
+from init import logging
+
+# Ключи апдейта, в которых Telegram передаёт отправителя
+_UPDATE_KINDS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "poll_answer", "my_chat_member", "chat_member", "chat_join_request",
+    "message_reaction", "business_message", "edited_business_message",
+)
+
+def extract_user_id(raw: dict) -> Optional[int]:
+    """Достаёт id пользователя из «сырого» апдейта (без разбора в модели aiogram)"""
+    for kind in _UPDATE_KINDS:
+        inner = raw.get(kind)
+        if not inner:
+            continue
+        user = inner.get("from") or inner.get("user")
+        if user and "id" in user:
+            return user["id"]
+        chat = inner.get("chat") or (inner.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return None
+
+class WorkerStartupError(Exception):
+    """Процесс-обработчик завершился, не успев подготовиться к работе"""
+
+class WorkerPool:
+    """Процессы-обработчики за «фронтом», который раскладывает апдейты по user_id.
+
+    Апдейты одного пользователя всегда попадают в один и тот же процесс
+    и в порядке поступления, поэтому кэши и состояние FSM остаются локальными.
+    Обработчик, упавший во время работы, перезапускается; если же процесс
+    не смог подготовиться (БД, миграции), фронт останавливается с WorkerStartupError.
+    """
+
+    def __init__(self, size: int, target: Callable[..., None]):
+        self.size = size
+        self._target = target
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues: list = []
+        self._processes: list = []
+        self._ready: list = []  # события «обработчик готов принимать апдейты»
+        self._stopping = False
+        # Записи логов обработчиков: файл лога пишет только главный процесс
+        self.log_queue = self._ctx.Queue()
+
+    def _spawn(self, index: int, queue):
+        ready = self._ctx.Event()
+        process = self._ctx.Process(
+            target=self._target, args=(index, queue, self.log_queue, ready),
+            name=f"bot-worker-{index}", daemon=False
+        )
+        process.start()
+        return process, ready
+
+    def start(self):
+        """Запускает обработчики и ждёт, пока каждый подключится к БД (блокирующий)"""
+        for index in range(self.size):
+            queue = self._ctx.Queue()
+            process, ready = self._spawn(index, queue)
+            self._queues.append(queue)
+            self._processes.append(process)
+            self._ready.append(ready)
+        for process, ready in zip(self._processes, self._ready):
+            while not ready.wait(1):
+                if not process.is_alive():
+                    raise WorkerStartupError(f"{process.name} завершился при запуске (код {process.exitcode})")
+        logging.info("👷 Запущено процессов-обработчиков: %s", self.size)
+
+    def _restart(self, index: int):
+        """Перезапускает упавший обработчик с новой очередью и переносит в неё недоставленные апдейты"""
+        process = self._processes[index]
+        if not self._ready[index].is_set():
+            raise WorkerStartupError(f"{process.name} завершился при запуске (код {process.exitcode})")
+        logging.error("❌ %s неожиданно завершился (код %s), перезапускаю", process.name, process.exitcode)
+
+        old_queue = self._queues[index]
+        queue = self._ctx.Queue()
+        moved = 0
+        while True:
+            try:
+                queue.put(old_queue.get(timeout=0.05))
+            except Empty:
+                break
+            moved += 1
+        old_queue.close()
+        old_queue.cancel_join_thread()
+        if moved:
+            logging.info("📨 Передано недоставленных апдейтов новому %s: %s", process.name, moved)
+
+        self._processes[index], self._ready[index] = self._spawn(index, queue)
+        self._queues[index] = queue
+
+    def check(self):
+        """Перезапускает завершившиеся обработчики; бросает WorkerStartupError, если перезапуск не удался"""
+        if self._stopping:
+            return
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                self._restart(index)
+
+    async def supervise(self, interval: float = 1):
+        """Следит за обработчиками, пока работает фронт"""
+        while True:
+            await asyncio.sleep(interval)
+            self.check()
+
+    def route(self, raw: dict):
+        """Отправляет апдейт процессу, закреплённому за пользователем"""
+        user_id = extract_user_id(raw)
+        index = user_id % self.size if user_id is not None else raw.get("update_id", 0) % self.size
+        if not self._processes[index].is_alive():
+            # Не оставляем апдейт в очереди, которую никто не читает
+            self._restart(index)
+        self._queues[index].put(raw)
+
+    def stop(self, timeout: float = 30):
+        """Просит процессы доработать очередь и завершиться"""
+        self._stopping = True
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning("⚠️ %s не завершился вовремя, останавливаю принудительно", process.name)
+                process.terminate()
+        self._queues.clear()
+        self._processes.clear()
+        self._ready.clear()
+
+async def consume_updates(queue: multiprocessing.Queue, handle: Callable[[dict], Awaitable]):
+    """Обрабатывает апдейты из очереди фронта внутри процесса-обработчика.
+
+    Разные пользователи обрабатываются параллельно, апдейты одного пользователя —
+    строго по очереди. Возвращается, когда фронт прислал None и всё обработано.
+    """
+    loop = asyncio.get_running_loop()
+    incoming: asyncio.Queue = asyncio.Queue()
+
+    # Чтение межпроцессной очереди блокирующее — выносим его в отдельный поток
+    def reader():
+        while True:
+            raw = queue.get()
+            loop.call_soon_threadsafe(incoming.put_nowait, raw)
+            if raw is None:
+                return
+
+    threading.Thread(target=reader, name="update-reader", daemon=True).start()
+
+    pending: dict[int, deque] = {}
+    drains: set[asyncio.Task] = set()
+
+    async def drain(user_id: int):
+        updates = pending[user_id]
+        while updates:
+            raw = updates.popleft()
+            try:
+                await handle(raw)
+            except Exception:
+                logging.exception("❌ Ошибка при обработке апдейта")
+        del pending[user_id]
+
+    while True:
+        raw = await incoming.get()
+        if raw is None:
+            break
+        user_id = extract_user_id(raw) or 0
+        if user_id in pending:
+            pending[user_id].append(raw)
+            continue
+        pending[user_id] = deque([raw])
+        task = asyncio.create_task(drain(user_id))
+        drains.add(task)
+        task.add_done_callback(drains.discard)
+
+    if drains:
+        await asyncio.gather(*drains, return_exceptions=True)